@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import pathlib
+import copy
 import yaml
 import os
 
@@ -20,6 +21,7 @@ def get_db_config(config):
             "bucket": config["INFLUXDB"]["BUCKET"],
             "url": config["INFLUXDB"]["URL"],
             "org": config["INFLUXDB"]["ORG"],
+            "store_path": config["INFLUXDB"].get("STORE", {}).get("PATH"),
         }
     else:
         return {
@@ -27,6 +29,7 @@ def get_db_config(config):
             "bucket": config["influxdb"]["bucket"],
             "url": config["influxdb"]["url"],
             "org": config["influxdb"]["org"],
+            "store_path": config["influxdb"].get("store", {}).get("path"),
         }
 
 
@@ -34,3 +37,38 @@ def load_config(config_path=CONFIG_PATH):
     path = str(abs_path(config_path))
     with open(path, "r") as file:
         return yaml.load(file, Loader=yaml.SafeLoader)
+
+
+def merge_config(base, override):
+    merged = copy.deepcopy(base)
+
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+
+    return merged
+
+
+def get_kindle_hostname_list(config):
+    if "KINDLE" not in config:
+        return []
+
+    return [kindle["HOSTNAME"] for kindle in config["KINDLE"]["LIST"]]
+
+
+# NOTE: 複数の Kindle に表示する場合，KINDLE.LIST の各要素に書かれた設定
+# (PANEL や LAYOUT 等) で全体の設定を上書きしたものを使う
+def get_device_config(config, hostname):
+    if "KINDLE" not in config:
+        return config
+
+    for kindle in config["KINDLE"]["LIST"]:
+        if kindle["HOSTNAME"] == hostname:
+            return merge_config(
+                config,
+                {key: value for key, value in kindle.items() if key != "HOSTNAME"},
+            )
+
+    return config
@@ -4,17 +4,22 @@
 電子ペーパ表示用の画像を生成します．
 
 Usage:
-  create_image.py [-c CONFIG] [-o PNG_FILE]
+  create_image.py [-c CONFIG] [-t HOSTNAME] [-o PNG_FILE] [-T EPOCH]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
+  -t HOSTNAME  : KINDLE.LIST のうち，指定された Kindle 向けの設定で生成します．
   -o PNG_FILE  : 生成した画像を指定されたパスに保存します．
+  -T EPOCH     : 現在時刻の代わりに，指定された UNIX 時間を表示します．
 """
 
 from docopt import docopt
 
 import sys
+import datetime
+import pathlib
 import PIL.Image
+import PIL.ImageDraw
 import logging
 import traceback
 import textwrap
@@ -23,7 +28,12 @@ import notify_slack
 import logger
 from sensor_panel import draw_sensor_panel
 from pil_util import draw_text, get_font, convert_to_gray
-from config import load_config
+from config import load_config, get_device_config
+import png_encoder
+
+# NOTE: 使われてなさそうな値にしておく．
+# display_image.py はこの値で画像生成時のエラーを判定する．
+ERROR_CODE = 222
 
 
 def notify_error(config, message):
@@ -36,64 +46,86 @@ def notify_error(config, message):
     )
 
 
-######################################################################
-args = docopt(__doc__)
-
-logger.init("panel.kindle.sensor", level=logging.INFO)
-
-logging.info("Start to create image")
-
-config_file = args["-c"]
+def create_image(config, panel_data=None, date=None):
+    logging.info("Start to create image")
 
-logging.info("Using config config: {config_file}".format(config_file=config_file))
-config = load_config(config_file)
-
-img = PIL.Image.new(
-    "RGBA",
-    (config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
-    (255, 255, 255, 255),
-)
-
-status = 0
-try:
-    draw_sensor_panel(config, img)
-except:
-    draw = PIL.ImageDraw.Draw(img)
-    draw.rectangle(
-        (0, 0, config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
-        fill=(255, 255, 255, 255),
+    # NOTE: 最終的にグレースケールで出力するので，最初から "L" で描画する．
+    # ガンマを考慮した変換は convert_to_gray() で LUT を 1 回適用するだけで済む
+    img = PIL.Image.new(
+        "L",
+        (config["PANEL"]["DEVICE"]["WIDTH"], config["PANEL"]["DEVICE"]["HEIGHT"]),
+        255,
     )
 
-    draw_text(
-        img,
-        "ERROR",
-        (10, 40),
-        get_font(config["FONT"], "EN_BOLD", 160),
-        "left",
-        "#666",
-    )
-
-    draw_text(
-        img,
-        "\n".join(textwrap.wrap(traceback.format_exc(), 60)),
-        (20, 180),
-        get_font(config["FONT"], "EN_MEDIUM", 36),
-        "left" "#333",
-    )
-    if "SLACK" in config:
-        notify_error(config, traceback.format_exc())
-
-    print(traceback.format_exc(), file=sys.stderr)
-    # NOTE: 使われてなさそうな値にしておく．
-    # display_image.py と合わせる必要あり．
-    status = 222
-
-if args["-o"] is not None:
-    out_file = args["-o"]
-else:
-    out_file = sys.stdout.buffer
-
-logging.info("Save {out_file}.".format(out_file=str(out_file)))
-convert_to_gray(img).save(out_file, "PNG")
-
-exit(status)
+    status = 0
+    try:
+        draw_sensor_panel(config, img, panel_data, date)
+    except:
+        draw = PIL.ImageDraw.Draw(img)
+        draw.rectangle(
+            (
+                0,
+                0,
+                config["PANEL"]["DEVICE"]["WIDTH"],
+                config["PANEL"]["DEVICE"]["HEIGHT"],
+            ),
+            fill=255,
+        )
+
+        draw_text(
+            img,
+            "ERROR",
+            (10, 40),
+            get_font(config["FONT"], "EN_BOLD", 160),
+            "left",
+            "#666",
+        )
+
+        draw_text(
+            img,
+            "\n".join(textwrap.wrap(traceback.format_exc(), 60)),
+            (20, 180),
+            get_font(config["FONT"], "EN_MEDIUM", 36),
+            "left" "#333",
+        )
+        if "SLACK" in config:
+            notify_error(config, traceback.format_exc())
+
+        print(traceback.format_exc(), file=sys.stderr)
+        status = ERROR_CODE
+
+    return (convert_to_gray(img), status)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    logger.init("panel.kindle.sensor", level=logging.INFO)
+
+    config_file = args["-c"]
+
+    logging.info("Using config config: {config_file}".format(config_file=config_file))
+    config = load_config(config_file)
+    if args["-t"] is not None:
+        config = get_device_config(config, args["-t"])
+
+    date = None
+    if args["-T"] is not None:
+        date = datetime.datetime.fromtimestamp(
+            float(args["-T"]), datetime.timezone(datetime.timedelta(hours=9), "JST")
+        )
+
+    img, status = create_image(config, date=date)
+
+    # NOTE: Kindle は 16 階調しか表示できないので，4bit の PNG で出力する
+    png = png_encoder.encode(img, **png_encoder.get_encoder_config(config))
+
+    if args["-o"] is not None:
+        out_file = args["-o"]
+        logging.info("Save {out_file}.".format(out_file=str(out_file)))
+        pathlib.Path(out_file).write_bytes(png)
+    else:
+        logging.info("Save {out_file}.".format(out_file=str(sys.stdout.buffer)))
+        sys.stdout.buffer.write(png)
+
+    exit(status)
@@ -4,40 +4,70 @@
 電子ペーパ表示用の画像を表示します．
 
 Usage:
-  display_image.py [-c CONFIG] [-t HOSTNAME] [-s]
+  display_image.py [-c CONFIG] [-t HOSTNAME] [-s] [-p]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
-  -t HOSTNAME  : 表示を行う Raspberry Pi のホスト名．
+  -t HOSTNAME  : 表示を行う Kindle のホスト名．省略時は設定ファイルの KINDLE.LIST
+                 に書かれた全ての Kindle に表示します．
   -s           : 1回のみ表示
+  -p           : 画像の生成を別プロセス (create_image.py) で行います．
 """
 
 from docopt import docopt
 
-import paramiko
 import datetime
 import subprocess
 import time
 import sys
 import os
-import gc
+import io
 import logging
 import pathlib
 import traceback
+import tarfile
+import collections
+import concurrent.futures
+import numpy as np
+import PIL.Image
 
 import logger
-from config import load_config
+from config import load_config, get_device_config, get_kindle_hostname_list
+from create_image import create_image, ERROR_CODE
+from sensor_panel import get_panel_data, get_item_region
+import frame_util
+from scheduler import TickScheduler, POLICY_SKIP
+from ssh_transport import KindleTransport
+import png_encoder
 import notify_slack
 
 NOTIFY_THRESHOLD = 2
 UPDATE_SEC = 60
-REFRESH = 60
 FAIL_MAX = 5
 
+# NOTE: 部分描画の設定
+DAMAGE_MERGE_GAP = 16
+DAMAGE_ALIGN = 8
+DAMAGE_REGION_MAX = 8
+DAMAGE_AREA_RATIO = 0.5
+
+# NOTE: 全画面リフレッシュの設定 (設定ファイルの PANEL.UPDATE.REFRESH で上書き可)
+REFRESH_AREA_RATIO = 3.0
+REFRESH_INTERVAL_MIN = 60
+
+# NOTE: 更新時刻の前倒しで準備を始める時間の見積もり
+PREPARE_HISTORY = 10
+PREPARE_DEFAULT_SEC = 10
+PREPARE_MARGIN_RATIO = 1.2
+PREPARE_MARGIN_SEC = 1
+
 CREATE_IMAGE = os.path.dirname(os.path.abspath(__file__)) + "/create_image.py"
 
 
 def notify_error(config, message):
+    if "SLACK" not in config:
+        return
+
     notify_slack.error(
         config["SLACK"]["BOT_TOKEN"],
         config["SLACK"]["ERROR"]["CHANNEL"]["NAME"],
@@ -47,32 +77,438 @@ def notify_error(config, message):
     )
 
 
-def ssh_connect(hostname):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname,
-        username="root",
-        password="mario",
-        allow_agent=False,
-        look_for_keys=False,
+def try_notify_error(config, message):
+    # NOTE: 通知に失敗しても，他の Kindle への表示は続ける
+    try:
+        notify_error(config, message)
+    except:
+        logging.warning(traceback.format_exc())
+
+
+def create_frame(device, config_file, panel_data, is_subprocess, date):
+    if is_subprocess:
+        # NOTE: 描画処理で問題が起きても影響しないように，別プロセスで生成する
+        proc = subprocess.Popen(
+            [
+                "python3",
+                CREATE_IMAGE,
+                "-c",
+                config_file,
+                "-t",
+                device["hostname"],
+                "-T",
+                str(date.timestamp()),
+            ],
+            stdout=subprocess.PIPE,
+        )
+        png = proc.communicate()[0]
+
+        return {
+            "img": PIL.Image.open(io.BytesIO(png)),
+            "png": png,
+            "status": proc.returncode,
+        }
+    else:
+        # NOTE: フォントやレイアウト，InfluxDB のクライアント等を使い回せるように，
+        # プロセス内で生成する
+        img, status = create_image(device["config"], panel_data, date)
+
+        return {"img": img, "png": get_png(device, img), "status": status}
+
+
+def fetch_panel_data(config, is_subprocess, date):
+    # NOTE: 複数の Kindle に表示する場合でも，データの取得は 1 回で済ませる．
+    # 失敗した場合は，create_image 側で取得し直してエラー表示させる
+    if is_subprocess:
+        return None
+
+    try:
+        return get_panel_data(config, date)
+    except:
+        logging.warning(traceback.format_exc())
+        return None
+
+
+def get_png(device, img):
+    return png_encoder.encode(img, **device["encoder_config"])
+
+
+def get_refresh_config(config):
+    refresh_config = config["PANEL"]["UPDATE"].get("REFRESH", {})
+
+    return {
+        "area_ratio": refresh_config.get("AREA_RATIO", REFRESH_AREA_RATIO),
+        "interval_sec": refresh_config.get("INTERVAL_MIN", REFRESH_INTERVAL_MIN) * 60,
+    }
+
+
+def get_refresh_reason(device, area, size):
+    # NOTE: 残像は書き換えた面積に応じて溜まっていくので，前回の全画面リフレッシュ
+    # からの累積変化面積で判断し，変化が少なくても一定時間ごとには行う
+    refresh_config = device["refresh_config"]
+
+    if device["frame"] is None:
+        return "init"
+    elif (device["damage_area"] + area) >= (size * refresh_config["area_ratio"]):
+        return "area"
+    elif (time.time() - device["refresh_time"]) >= refresh_config["interval_sec"]:
+        return "interval"
+    else:
+        return None
+
+
+def is_partial_update(region_list, size):
+    # NOTE: 変化した領域が多い場合は，まとめて全画面を描画した方が速い
+    return (len(region_list) <= DAMAGE_REGION_MAX) and (
+        frame_util.get_region_area(region_list) <= (size * DAMAGE_AREA_RATIO)
     )
 
-    return ssh
 
+def send_to_receiver(device, frame_list):
+    if not device["use_receiver"]:
+        return False
+
+    transport = device["transport"]
+    try:
+        receiver = transport.get_receiver()
+    except Exception:
+        # NOTE: 受信スクリプトが動かない Kindle では，以降は exec での描画に切り替える
+        logging.warning(traceback.format_exc())
+        logging.warning(
+            "Disable frame receiver on {hostname}".format(hostname=device["hostname"])
+        )
+        transport.stop_receiver()
+        device["use_receiver"] = False
+        return False
 
-def display_image(ssh):
-    ssh_stdin = ssh.exec_command(
-        "cat - > draw.png && eips %s -g draw.png"
-        % ("-f" if (i % REFRESH) == 0 else ""),
-    )[0]
+    try:
+        for png, pos, is_refresh in frame_list:
+            receiver.send_frame(png, pos, is_refresh)
+        device["metrics"]["receiver"] += 1
+        return True
+    except Exception:
+        # NOTE: 途中で失敗した場合は，次回に受信スクリプトを起動し直す
+        logging.warning(traceback.format_exc())
+        transport.stop_receiver()
+        return False
+
+
+def display_full(device, png, is_refresh):
+    if send_to_receiver(device, [(png, (0, 0), is_refresh)]):
+        return len(png)
+
+    transport = device["transport"]
+    transport.upload("draw.png", png)
+    transport.run("eips %s -g draw.png" % ("-f" if is_refresh else ""))
+
+    return len(png)
+
+
+def display_partial(device, img, region_list):
+    png_list = [get_png(device, img.crop(region)) for region in region_list]
+
+    if send_to_receiver(
+        device,
+        [(png, region[:2], False) for png, region in zip(png_list, region_list)],
+    ):
+        return sum(map(len, png_list))
+
+    # NOTE: 変化した領域ごとの PNG を 1 回の転送で Kindle に送ってから，
+    # eips の位置指定描画で順に書き込む
+    archive = io.BytesIO()
+    command_list = []
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for i, (png, region) in enumerate(zip(png_list, region_list)):
+            name = "draw_{i}.png".format(i=i)
+
+            info = tarfile.TarInfo(name)
+            info.size = len(png)
+            tar.addfile(info, io.BytesIO(png))
+
+            command_list.append(
+                "eips -g {name} -x {x} -y {y}".format(
+                    name=name, x=region[0], y=region[1]
+                )
+            )
+
+    # NOTE: tar はレコード単位で末尾を 0 埋めするので，終端ブロックまでで切り詰める
+    data = archive.getvalue()[: tar.offset]
+
+    transport = device["transport"]
+    transport.upload("draw.tar", data)
+    transport.run("tar xf draw.tar && " + " && ".join(command_list))
+
+    return len(data)
+
+
+def display_image(device, frame, is_forced=False):
+    img = frame["img"]
+    curr = np.asarray(img)
+
+    # NOTE: PANEL.UPDATE.SKIP.MAX で強制的に送る場合，画素が同じでも画面全体を送り直す
+    region_list = None
+    if (device["frame"] is not None) and not is_forced:
+        region_list = frame_util.get_damage_region_list(
+            device["frame"], curr, DAMAGE_MERGE_GAP, DAMAGE_ALIGN
+        )
+
+    if region_list == []:
+        logging.info(
+            "Skip display to {hostname} since no pixel is changed".format(
+                hostname=device["hostname"]
+            )
+        )
+        device["metrics"]["skip"] += 1
+        return
+
+    device["metrics"]["push"] += 1
+
+    area = curr.size if region_list is None else frame_util.get_region_area(region_list)
+    refresh_reason = get_refresh_reason(device, area, curr.size)
+
+    if refresh_reason is not None:
+        logging.info(
+            "Display image to {hostname} with full refresh (reason: {reason})".format(
+                hostname=device["hostname"], reason=refresh_reason
+            )
+        )
+        size = display_full(device, frame["png"], True)
+        device["metrics"]["full"] += 1
+        device["metrics"]["refresh"] += 1
+        device["metrics"]["refresh." + refresh_reason] += 1
+        device["damage_area"] = 0
+        device["refresh_time"] = time.time()
+    elif (region_list is None) or not is_partial_update(region_list, curr.size):
+        logging.info("Display image to {hostname}".format(hostname=device["hostname"]))
+        size = display_full(device, frame["png"], False)
+        device["metrics"]["full"] += 1
+        device["damage_area"] += area
+    else:
+        logging.info(
+            "Display {count} region(s) to {hostname}: {region_list}".format(
+                count=len(region_list),
+                hostname=device["hostname"],
+                region_list=region_list,
+            )
+        )
+        size = display_partial(device, img, region_list)
+        device["metrics"]["partial"] += 1
+        device["damage_area"] += area
 
-    proc = subprocess.Popen(["python3", CREATE_IMAGE], stdout=subprocess.PIPE)
-    ssh_stdin.write(proc.communicate()[0])
-    ssh_stdin.close()
     sys.stdout.flush()
 
-    return proc
+    device["metrics"]["byte"] += size
+    device["frame"] = curr
+
+
+def get_skip_config(config):
+    if "SKIP" not in config["PANEL"]["UPDATE"]:
+        return {"mask_region": None, "max_skip": None}
+
+    skip_config = config["PANEL"]["UPDATE"]["SKIP"]
+
+    return {
+        "mask_region": (
+            get_item_region(config, "time")
+            if skip_config.get("IGNORE_TIME", False)
+            else None
+        ),
+        "max_skip": skip_config.get("MAX"),
+    }
+
+
+def log_metrics(device):
+    logging.info(
+        "Metrics of {hostname}: {metrics}".format(
+            hostname=device["hostname"], metrics=dict(device["metrics"])
+        )
+    )
+
+
+def check_status(status):
+    if status == 0:
+        logging.info("Success.")
+    elif status == ERROR_CODE:
+        logging.warn("Finish. (something is wrong)")
+        raise
+    else:
+        logging.error("Failed to create image. (code: {code})".format(code=status))
+        raise
+
+
+def setup_device(device):
+    transport = device["transport"]
+
+    logging.info("put the kindle into signage mode")
+    # NOTE: 既に停止している場合はエラーになるので，終了ステータスは見ない
+    transport.run("initctl stop powerd", check=False)
+    transport.run("initctl stop framework", check=False)
+
+
+def init_device(config, hostname):
+    logging.info("Kindle hostname: %s" % (hostname))
+
+    device_config = get_device_config(config, hostname)
+
+    return {
+        "hostname": hostname,
+        "config": device_config,
+        "skip_config": get_skip_config(device_config),
+        "refresh_config": get_refresh_config(device_config),
+        "encoder_config": png_encoder.get_encoder_config(device_config),
+        "transport": KindleTransport(hostname),
+        "use_receiver": device_config["PANEL"]["UPDATE"].get("RECEIVER", False),
+        "is_down": False,
+        "recover_future": None,
+        "fail_count": 0,
+        "frame_hash": None,
+        "frame": None,
+        "skip_count": 0,
+        "damage_area": 0,
+        "refresh_time": time.time(),
+        "metrics": collections.Counter(),
+    }
+
+
+def get_date(update_time):
+    return datetime.datetime.fromtimestamp(
+        update_time, datetime.timezone(datetime.timedelta(hours=9), "JST")
+    )
+
+
+def get_prepare_sec(prepare_sec_list):
+    # NOTE: 直近の準備時間の最大値に余裕を持たせて，準備を始める時刻を決める
+    if len(prepare_sec_list) == 0:
+        return PREPARE_DEFAULT_SEC
+
+    return max(prepare_sec_list) * PREPARE_MARGIN_RATIO + PREPARE_MARGIN_SEC
+
+
+def prepare_frame_list(config, device_list, config_file, is_subprocess, date):
+    panel_data = fetch_panel_data(config, is_subprocess, date)
+
+    frame_list = []
+    for device in device_list:
+        try:
+            frame = create_frame(device, config_file, panel_data, is_subprocess, date)
+            device["metrics"]["frame"] += 1
+        except:
+            logging.error(traceback.format_exc())
+            frame = None
+
+        frame_list.append(frame)
+
+    return frame_list
+
+
+def push_frame(executor, device, frame):
+    if frame is None:
+        device["status"] = -1
+        return None
+
+    device["status"] = frame["status"]
+
+    # NOTE: 表示内容が変わっていない場合は，転送と再描画を省略する．
+    # ハッシュが前回と同じなのに変化ありとされた場合は，SKIP.MAX による強制的な転送
+    prev_hash = device["frame_hash"]
+    if (frame["status"] == 0) and not frame_util.is_frame_changed(
+        device, frame["img"], **device["skip_config"]
+    ):
+        logging.info(
+            "Skip display to {hostname} since the frame is not changed".format(
+                hostname=device["hostname"]
+            )
+        )
+        device["metrics"]["skip"] += 1
+        return executor.submit(lambda: None)
+
+    is_forced = (
+        (frame["status"] == 0)
+        and (prev_hash is not None)
+        and (device["frame_hash"] == prev_hash)
+    )
+
+    return executor.submit(display_image, device, frame, is_forced)
+
+
+def reset_device(device):
+    # NOTE: 次回の転送時に，バックオフしながら再接続する
+    device["transport"].close()
+    device["frame_hash"] = None
+    device["frame"] = None
+
+
+def mark_device_down(config, device):
+    # NOTE: 1 台の Kindle が応答しなくても他の Kindle への表示は続け，
+    # 停止した Kindle には裏で再接続を試みる
+    try_notify_error(config, traceback.format_exc())
+    logging.error(
+        "Stop display to {hostname} until it recovers".format(
+            hostname=device["hostname"]
+        )
+    )
+    reset_device(device)
+    device["is_down"] = True
+    device["fail_count"] = 0
+
+
+def check_down_device(executor, device_list):
+    for device in device_list:
+        if not device["is_down"]:
+            continue
+
+        future = device["recover_future"]
+        if future is None:
+            device["recover_future"] = executor.submit(setup_device, device)
+        elif future.done():
+            device["recover_future"] = None
+            if future.exception() is None:
+                logging.info(
+                    "Resume display to {hostname}".format(hostname=device["hostname"])
+                )
+                device["is_down"] = False
+            else:
+                logging.warning(
+                    "Failed to reconnect to {hostname}: {error}".format(
+                        hostname=device["hostname"], error=future.exception()
+                    )
+                )
+                device["transport"].close()
+
+
+def check_all_down(device_list):
+    if all(device["is_down"] for device in device_list):
+        logging.error("全ての Kindle でエラーが続いたので終了します．")
+        sys.exit(-1)
+
+
+def check_result(config, push_list, is_one_time):
+    is_failed = False
+    for device, future in push_list:
+        try:
+            if future is None:
+                raise
+            future.result()
+            check_status(device["status"])
+
+            device["fail_count"] = 0
+            pathlib.Path(config["LIVENESS"]["FILE"]).touch()
+        except:
+            device["fail_count"] += 1
+
+            if is_one_time:
+                notify_error(config, traceback.format_exc())
+                is_failed = True
+            elif device["fail_count"] >= NOTIFY_THRESHOLD:
+                mark_device_down(config, device)
+            else:
+                reset_device(device)
+
+        log_metrics(device)
+
+    if is_failed:
+        logging.error("エラーが発生したので終了します．")
+        sys.exit(-1)
 
 
 ######################################################################
@@ -81,69 +517,77 @@ args = docopt(__doc__)
 logger.init("panel.kindle.sensor", level=logging.INFO)
 
 is_one_time = args["-s"]
+is_subprocess = args["-p"]
 kindle_hostname = os.environ.get("KINDLE_HOSTNAME", args["-t"])
 
-logging.info("Kindle hostname: %s" % (kindle_hostname))
-
 config = load_config(args["-c"])
 
-try:
-    ssh = ssh_connect(kindle_hostname)
-    logging.info("put the kindle into signage mode")
-    ssh.exec_command("initctl stop powerd")
-    ssh.exec_command("initctl stop framework")
-except:
-    notify_error(config, traceback.format_exc())
-    logging.error(traceback.format_exc())
+if kindle_hostname is not None:
+    hostname_list = [kindle_hostname]
+else:
+    hostname_list = get_kindle_hostname_list(config)
+
+if len(hostname_list) == 0:
+    logging.error("No Kindle is specified (use -t or KINDLE.LIST)")
+    try_notify_error(config, "表示する Kindle が指定されていません．")
     sys.exit(-1)
 
+device_list = [init_device(config, hostname) for hostname in hostname_list]
+for device in device_list:
+    try:
+        setup_device(device)
+    except:
+        logging.error(traceback.format_exc())
+        if is_one_time:
+            notify_error(config, traceback.format_exc())
+            sys.exit(-1)
+        mark_device_down(config, device)
+check_all_down(device_list)
+
+# NOTE: 転送は Kindle ごとに別の SSH セッションで並列に行う
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(device_list))
+
+scheduler = TickScheduler(
+    config["PANEL"]["UPDATE"]["INTERVAL"],
+    config["PANEL"]["UPDATE"].get("MISS_POLICY", POLICY_SKIP),
+)
+prepare_sec_list = collections.deque(maxlen=PREPARE_HISTORY)
+push_list = None
 
-i = 0
-fail_count = 0
 while True:
-    ssh_stdin = None
-    try:
-        proc = display_image(ssh)
-
-        if proc.returncode == 0:
-            logging.info("Success.")
-        elif proc.returncode == 222:
-            logging.warn("Finish. (something is wrong)")
-            raise
-        else:
-            logging.error(
-                "Failed to create image. (code: {code})".format(code=proc.returncode)
-            )
-            raise
+    update_time = scheduler.next()
 
-        logging.info("Success.")
-        pathlib.Path(config["LIVENESS"]["FILE"]).touch()
+    check_down_device(executor, device_list)
+    active_list = [device for device in device_list if not device["is_down"]]
 
-        if is_one_time:
-            break
-    except:
-        fail_count += 1
+    # NOTE: データの取得と描画は更新時刻より前に済ませておき，更新時刻ちょうどに転送する
+    scheduler.wait_until(update_time - get_prepare_sec(prepare_sec_list))
 
-        if is_one_time or (fail_count >= NOTIFY_THRESHOLD):
-            notify_error(config, traceback.format_exc())
-            logging.error("エラーが続いたので終了します．")
-            raise
-        else:
-            time.sleep(10)
-            ssh = ssh_connect(kindle_hostname)
-            pass
-
-    # close だけだと，SSH 側がしばらく待っていることがあったので，念のため
-    del ssh_stdin
-    gc.collect()
-
-    # 更新されていることが直感的に理解しやすくなるように，更新タイミングを 0 秒
-    # に合わせる
-    # (例えば，1分間隔更新だとして，1分40秒に更新されると，2分40秒まで更新されないので
-    # 2分45秒くらいに表示を見た人は本当に1分間隔で更新されているのか心配になる)
-    sleep_time = config["PANEL"]["UPDATE"]["INTERVAL"] - datetime.datetime.now().second
-    logging.info("sleep {sleep_time} sec...".format(sleep_time=sleep_time))
-    sys.stderr.flush()
-    time.sleep(sleep_time)
-
-    i += 1
+    prepare_start = time.time()
+    frame_list = prepare_frame_list(
+        config, active_list, args["-c"], is_subprocess, get_date(update_time)
+    )
+    prepare_sec_list.append(time.time() - prepare_start)
+
+    # NOTE: 前回の転送が終わっていなくても次のフレームの準備を進められるように，
+    # 転送結果はここで確認する
+    if push_list is not None:
+        check_result(config, push_list, is_one_time)
+        check_all_down(device_list)
+
+    scheduler.wait_until(update_time)
+
+    # NOTE: 前回の転送結果を確認した時点で停止扱いになった Kindle には送らない
+    push_list = [
+        (device, push_frame(executor, device, frame))
+        for device, frame in zip(active_list, frame_list)
+        if not device["is_down"]
+    ]
+    logging.info(
+        "Push frames (prepare: {prepare:.2f} sec)".format(prepare=prepare_sec_list[-1])
+    )
+    scheduler.report(time.time())
+
+    if is_one_time:
+        check_result(config, push_list, is_one_time)
+        break
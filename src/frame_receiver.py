@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kindle 上の受信スクリプト (kindle_receiver.sh) に画像を送ります．
+Linux 上で受信スクリプトを起動して，プロトコルの動作を確認できます．
+
+Usage:
+  frame_receiver.py -i PNG_FILE [-e EIPS] [-n COUNT]
+
+Options:
+  -i PNG_FILE  : 送信する画像．
+  -e EIPS      : 受信側で eips の代わりに実行するコマンド．[default: true]
+  -n COUNT     : 送信する回数．[default: 10]
+"""
+
+from docopt import docopt
+
+import os
+import subprocess
+import time
+import logging
+
+RECEIVER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "kindle_receiver.sh"
+)
+
+
+def load_receiver_script():
+    with open(RECEIVER_SCRIPT, "rb") as f:
+        return f.read()
+
+
+def to_str(line):
+    return line.decode() if isinstance(line, bytes) else line
+
+
+# NOTE: 受信スクリプトの標準入出力と，FRAME/QUIT コマンドでやりとりする．
+# SSH のチャンネルでも，ローカルのプロセスのパイプでも同じように扱える
+class FrameReceiver:
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+
+        self.wait_reply("READY")
+
+    def wait_reply(self, expect="OK"):
+        reply = to_str(self.stdout.readline()).strip()
+
+        if reply != expect:
+            raise RuntimeError(
+                "Unexpected reply from receiver: '{reply}'".format(reply=reply)
+            )
+
+    def send_frame(self, png, pos=(0, 0), is_refresh=False):
+        self.stdin.write(
+            "FRAME {size} {x} {y} {refresh}\n".format(
+                size=len(png), x=pos[0], y=pos[1], refresh=1 if is_refresh else 0
+            ).encode()
+            + png
+        )
+        self.stdin.flush()
+
+        self.wait_reply()
+
+    def close(self):
+        try:
+            self.stdin.write(b"QUIT\n")
+            self.stdin.flush()
+            self.wait_reply()
+        except Exception:
+            pass
+
+
+def start_local_receiver(eips):
+    proc = subprocess.Popen(
+        ["sh", RECEIVER_SCRIPT],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=dict(os.environ, EIPS=eips),
+    )
+
+    return (proc, FrameReceiver(proc.stdin, proc.stdout))
+
+
+if __name__ == "__main__":
+    import logger
+
+    args = docopt(__doc__)
+
+    logger.init("panel.kindle.sensor", level=logging.INFO)
+
+    with open(args["-i"], "rb") as f:
+        png = f.read()
+    count = int(args["-n"])
+
+    proc, receiver = start_local_receiver(args["-e"])
+
+    start = time.perf_counter()
+    for i in range(count):
+        receiver.send_frame(png, (0, 0), i == 0)
+    elapsed = (time.perf_counter() - start) / count
+
+    receiver.close()
+    proc.wait()
+
+    logging.info(
+        "Sent {count} frames of {size:,} bytes: {elapsed:.2f} msec/frame".format(
+            count=count, size=len(png), elapsed=elapsed * 1000
+        )
+    )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import numpy as np
+
+
+def get_frame_hash(img, mask_region=None):
+    frame = np.asarray(img)
+
+    if mask_region is not None:
+        # NOTE: 更新時刻のように，変化しても表示を更新したくない領域は塗りつぶして比較する
+        frame = frame.copy()
+        frame[mask_region[1] : mask_region[3], mask_region[0] : mask_region[2]] = 0
+
+    return hashlib.blake2b(np.ascontiguousarray(frame), digest_size=16).hexdigest()
+
+
+def is_frame_changed(state, img, mask_region=None, max_skip=None):
+    frame_hash = get_frame_hash(img, mask_region)
+
+    if (frame_hash == state.get("frame_hash")) and (
+        (max_skip is None) or (state["skip_count"] < max_skip)
+    ):
+        state["skip_count"] += 1
+        return False
+
+    state["frame_hash"] = frame_hash
+    state["skip_count"] = 0
+
+    return True
+
+
+def get_damage_region_list(prev, curr, merge_gap=16, align=8):
+    prev = np.asarray(prev)
+    curr = np.asarray(curr)
+
+    if prev.shape != curr.shape:
+        return None
+
+    diff = prev != curr
+
+    row_index = np.flatnonzero(diff.any(axis=1))
+    if len(row_index) == 0:
+        return []
+
+    # NOTE: 近接している行はまとめて 1 つの矩形にし，eips の呼び出し回数を抑える
+    split_index = np.flatnonzero(np.diff(row_index) > merge_gap) + 1
+
+    width = curr.shape[1]
+    region_list = []
+    for row_list in np.split(row_index, split_index):
+        top = int(row_list[0])
+        bottom = int(row_list[-1]) + 1
+
+        col_index = np.flatnonzero(diff[top:bottom].any(axis=0))
+        left = int(col_index[0]) // align * align
+        right = min(-(-(int(col_index[-1]) + 1) // align) * align, width)
+
+        region_list.append((left, top, right, bottom))
+
+    return region_list
+
+
+def get_region_area(region_list):
+    return sum(map(lambda r: (r[2] - r[0]) * (r[3] - r[1]), region_list))
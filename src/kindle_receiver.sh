@@ -0,0 +1,56 @@
+#!/bin/sh
+#
+# Kindle 上で常駐させて，display_image.py から送られてくる画像を表示します．
+# display_image.py が SSH で転送して起動するので，手動で配置する必要はありません．
+#
+# 標準入力から次の形式のコマンドを受け取り，1 コマンドごとに 1 行で応答します．
+#
+#   FRAME <サイズ> <X> <Y> <リフレッシュ>\n<PNG データ (サイズ バイト)>
+#     -> OK | NG <理由>
+#   QUIT
+#
+# 環境変数 EIPS で eips の代わりに実行するコマンドを指定できるので，
+# Linux 上で EIPS=echo として動作を確認できます．
+
+EIPS=${EIPS:-eips}
+FRAME_FILE=${FRAME_FILE:-/tmp/kindle_receiver.png}
+
+echo READY
+
+while read -r command size x y refresh; do
+    case "$command" in
+    FRAME)
+        # NOTE: read は改行までしか読まないので，続きをそのまま PNG として受け取れる
+        head -c "$size" > "$FRAME_FILE"
+
+        # NOTE: 受け取ったサイズが違う場合，以降のコマンドの区切りがずれるので終了する
+        actual=$(wc -c < "$FRAME_FILE")
+        if [ "$actual" -ne "$size" ]; then
+            echo "NG size $actual"
+            exit 1
+        fi
+
+        flag=""
+        if [ "$refresh" = "1" ]; then
+            flag="-f"
+        fi
+        position=""
+        if [ "$x" != "0" ] || [ "$y" != "0" ]; then
+            position="-x $x -y $y"
+        fi
+
+        if $EIPS $flag -g "$FRAME_FILE" $position > /dev/null 2>&1; then
+            echo OK
+        else
+            echo "NG eips $?"
+        fi
+        ;;
+    QUIT)
+        echo OK
+        exit 0
+        ;;
+    *)
+        echo "NG command $command"
+        ;;
+    esac
+done
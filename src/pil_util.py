@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import math
 import pathlib
+import functools
+import collections
+import PIL.Image
+import PIL.ImageColor
 import PIL.ImageDraw
+import PIL.ImageFont
 import logging
 
 # NOTE: 詳細追えてないものの，英語フォントでボディサイズがおかしいものがあったので，
 # 補正できるようにする．
 EN_FONT_HEIGHT_FACTOR = 0.75
 
+FONT_CACHE_SIZE = 32
+TEXT_CACHE_SIZE = 4096
+
+GAMMA = 2.2
+LINEAR_LUT = [int(pow(x / 255.0, GAMMA) * 255) for x in range(256)]
+GAMMA_LUT = [int(pow(x / 255.0, 1.0 / GAMMA) * 255) for x in range(256)]
+GRAY_LUT = [GAMMA_LUT[LINEAR_LUT[x]] for x in range(256)]
+GRAY_INV_LUT = [min(range(256), key=lambda v: abs(GRAY_LUT[v] - x)) for x in range(256)]
+
+TextMetrics = collections.namedtuple("TextMetrics", ["bbox", "advance", "size"])
+Glyph = collections.namedtuple("Glyph", ["mask", "origin", "advance"])
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font_impl(font_path, size):
+    logging.info("Load font: {path} ({size}px)".format(path=font_path, size=size))
+
+    return PIL.ImageFont.truetype(font_path, size)
+
+
+def load_font(font_path, size):
+    # NOTE: 同じフォントを別のパス表記で指定されても共有できるように正規化する
+    return load_font_impl(str(pathlib.Path(font_path).resolve()), size)
+
+
+def font_cache_info():
+    return load_font_impl.cache_info()
+
 
 def get_font(config, font_type, size):
     font_path = str(
@@ -17,13 +51,24 @@ def get_font(config, font_type, size):
         )
     )
 
-    logging.info("Load font: {path}".format(path=font_path))
+    return load_font(font_path, size)
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def measure_text(font, text):
+    # NOTE: Pillow 10 で削除された getsize() の代わりに getbbox()/getlength() を使う．
+    # size は getsize() と同じく，描画位置から右下端までの大きさ
+    bbox = font.getbbox(text)
+
+    return TextMetrics(bbox, font.getlength(text), (bbox[2], bbox[3]))
 
-    return PIL.ImageFont.truetype(font_path, size)
+
+def text_cache_info():
+    return measure_text.cache_info()
 
 
 def text_size(font, text, need_padding_change=True):
-    size = font.getsize(text)
+    size = measure_text(font, text).size
 
     if need_padding_change:
         return (size[0], size[1] * EN_FONT_HEIGHT_FACTOR)
@@ -43,16 +88,19 @@ def draw_text(
     stroke_fill=None,
 ):
     draw = PIL.ImageDraw.Draw(img)
+    size = text_size(font, text)
 
     if align == "center":
-        pos = (int(pos[0] - text_size(font, text)[0] / 2.0), int(pos[1]))
+        pos = (int(pos[0] - size[0] / 2.0), int(pos[1]))
     elif align == "right":
-        pos = (int(pos[0] - text_size(font, text)[0]), int(pos[1]))
+        pos = (int(pos[0] - size[0]), int(pos[1]))
 
     if need_padding_change:
         pos = (
             pos[0],
-            int(pos[1] - font.getsize(text)[1] * (1 - EN_FONT_HEIGHT_FACTOR)),
+            int(
+                pos[1] - measure_text(font, text).size[1] * (1 - EN_FONT_HEIGHT_FACTOR)
+            ),
         )
 
     draw.text(
@@ -61,12 +109,12 @@ def draw_text(
         color,
         font,
         None,
-        text_size(font, text)[1] * 0.4,
+        size[1] * 0.4,
         stroke_width=stroke_width,
         stroke_fill=stroke_fill,
     )
 
-    return (pos[0] + text_size(font, text)[0], pos[1] + text_size(font, text)[1])
+    return (pos[0] + size[0], pos[1] + size[1])
 
 
 def load_image(img_config):
@@ -96,8 +144,104 @@ def alpha_paste(img, paint_img, pos):
 
 
 def convert_to_gray(img):
+    if img.mode == "L":
+        # NOTE: 無彩色の場合，ガンマを考慮した変換は GRAY_LUT を 1 回適用するのと同じ
+        return img.point(GRAY_LUT)
+
     img = img.convert("RGB")
-    img = img.point(([int(pow(x / 255.0, 2.2) * 255) for x in range(256)] * 3))
+    img = img.point(LINEAR_LUT * 3)
     img = img.convert("L")
-    img = img.point([int(pow(x / 255.0, 1.0 / 2.2) * 255) for x in range(256)])
+    img = img.point(GAMMA_LUT)
     return img
+
+
+def convert_to_gray_canvas(img):
+    # NOTE: "L" のキャンバスに貼り付ける画像は，最後に GRAY_LUT が適用されても
+    # convert_to_gray() と同じ結果になるように変換しておく
+    return convert_to_gray(img.convert("RGBA")).point(GRAY_INV_LUT)
+
+
+class GlyphAtlas:
+    # NOTE: 数値のように文字種が少ない文字列を，FreeType を介さずにビットマップの
+    # 貼り付けだけで描画する．draw.text() と同じ結果になるように，描画位置の
+    # 小数部ごとにラスタライズしたものをキャッシュする．
+    def __init__(self, font, charset):
+        logging.info("Build glyph atlas: {charset}".format(charset=charset))
+
+        self.font = font
+        self.metrics_map = {}
+        self.glyph_map = {}
+
+        for char in charset:
+            self.metrics_map[char] = (font.getbbox(char), font.getlength(char))
+            self.get_glyph(char, 0.0, 0.0)
+
+        self.kerning_map = {}
+        for left in charset:
+            for right in charset:
+                kerning = (
+                    font.getlength(left + right)
+                    - self.metrics_map[left][1]
+                    - self.metrics_map[right][1]
+                )
+                if kerning != 0:
+                    self.kerning_map[(left, right)] = kerning
+
+    def get_glyph(self, char, phase_x, phase_y):
+        key = (char, phase_x, phase_y)
+
+        if key not in self.glyph_map:
+            bbox = self.metrics_map[char][0]
+            if (bbox[2] > bbox[0]) and (bbox[3] > bbox[1]):
+                # NOTE: 小数部の分だけずれても収まるように 1px の余白を設ける．
+                # また，draw.text() は座標を int() で切り捨てるので，負の座標に
+                # ならないようにしてから描画して切り出す
+                pad = (1 + max(0, -bbox[0]), 1 + max(0, -bbox[1]))
+                canvas = PIL.Image.new(
+                    "L", (pad[0] + bbox[2] + 1, pad[1] + bbox[3] + 1), 0
+                )
+                PIL.ImageDraw.Draw(canvas).text(
+                    (pad[0] + phase_x, pad[1] + phase_y), char, 255, self.font
+                )
+                origin = (1 - bbox[0], 1 - bbox[1])
+                mask = canvas.crop(
+                    (
+                        pad[0] + bbox[0] - 1,
+                        pad[1] + bbox[1] - 1,
+                        canvas.size[0],
+                        canvas.size[1],
+                    )
+                )
+            else:
+                origin = (0, 0)
+                mask = None
+
+            self.glyph_map[key] = Glyph(mask, origin, self.metrics_map[char][1])
+
+        return self.glyph_map[key]
+
+    def can_draw(self, text):
+        return all(map(lambda char: char in self.metrics_map, text))
+
+    def draw(self, img, pos, text, color):
+        ink = PIL.ImageColor.getcolor(color, img.mode)
+        pen_x = pos[0]
+        phase_y = math.modf(pos[1])[0]
+
+        for i, char in enumerate(text):
+            if i != 0:
+                pen_x += self.kerning_map.get((text[i - 1], char), 0)
+
+            glyph = self.get_glyph(char, math.modf(pen_x)[0], phase_y)
+            if glyph.mask is not None:
+                img.paste(
+                    ink,
+                    (int(pen_x) - glyph.origin[0], int(pos[1]) - glyph.origin[1]),
+                    glyph.mask,
+                )
+            pen_x += glyph.advance
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_glyph_atlas(font, charset):
+    return GlyphAtlas(font, charset)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kindle 向けに 16 階調 (4bit) のグレースケール PNG を生成します．
+
+Usage:
+  png_encoder.py -i PNG_FILE [-n COUNT] [-o PNG_FILE]
+
+Options:
+  -i PNG_FILE  : ベンチマークに使う画像．
+  -n COUNT     : 計測を繰り返す回数．[default: 20]
+  -o PNG_FILE  : 4bit で出力した画像を指定されたパスに保存します．
+"""
+
+from docopt import docopt
+
+import io
+import zlib
+import struct
+import time
+import numpy as np
+import PIL.Image
+
+# NOTE: Kindle Paperwhite は 16 階調しか表示できないので，8bit で送っても無駄になる
+LEVEL_COUNT = 16
+
+# NOTE: 転送時間よりも Raspberry Pi での圧縮時間の方が支配的なので，速度優先
+COMPRESS_LEVEL = 1
+COMPRESS_STRATEGY = "RLE"
+
+STRATEGY_MAP = {
+    "DEFAULT": zlib.Z_DEFAULT_STRATEGY,
+    "FILTERED": zlib.Z_FILTERED,
+    "HUFFMAN_ONLY": zlib.Z_HUFFMAN_ONLY,
+    "RLE": zlib.Z_RLE,
+    "FIXED": zlib.Z_FIXED,
+}
+
+BAYER_MATRIX = np.array(
+    [
+        [0, 8, 2, 10],
+        [12, 4, 14, 6],
+        [3, 11, 1, 9],
+        [15, 7, 13, 5],
+    ],
+    dtype=np.float32,
+)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# NOTE: 0〜255 を最も近い 0〜15 に割り当てる
+QUANTIZE_LUT = ((np.arange(256, dtype=np.uint32) * 15 + 127) // 255).astype(np.uint8)
+QUANTIZE_TABLE = QUANTIZE_LUT.tolist()
+
+
+def get_encoder_config(config):
+    png_config = config["PANEL"].get("PNG", {})
+
+    return {
+        "dither": png_config.get("DITHER", False),
+        "level": png_config.get("COMPRESS_LEVEL", COMPRESS_LEVEL),
+        "strategy": png_config.get("COMPRESS_STRATEGY", COMPRESS_STRATEGY),
+    }
+
+
+def quantize(img, dither=False):
+    if not dither:
+        # NOTE: NumPy の fancy index よりも，PIL の point の方がかなり速い
+        return np.asarray(img.point(QUANTIZE_TABLE))
+
+    gray = np.asarray(img)
+
+    # NOTE: 組織的ディザリング．閾値の平均が 0.5 なので，平均の明るさは保たれる
+    height, width = gray.shape
+    threshold = (
+        np.tile(BAYER_MATRIX, ((height + 3) // 4, (width + 3) // 4))[:height, :width]
+        + 0.5
+    ) / 16
+
+    return np.minimum(
+        gray * np.float32((LEVEL_COUNT - 1) / 255) + threshold, LEVEL_COUNT - 1
+    ).astype(np.uint8)
+
+
+def pack_4bit(level):
+    height, width = level.shape
+
+    if (width % 2) != 0:
+        level = np.hstack((level, np.zeros((height, 1), dtype=np.uint8)))
+
+    packed = (level[:, 0::2] << 4) | level[:, 1::2]
+
+    # NOTE: 各行の先頭にフィルタタイプ (2: Up) を付ける．パネルの画像は縦方向に
+    # 同じ行が続くことが多く，RLE と組み合わせると None よりかなり小さくなる
+    row = np.empty((height, 1 + packed.shape[1]), dtype=np.uint8)
+    row[:, 0] = 2
+    row[0, 1:] = packed[0]
+    np.subtract(packed[1:], packed[:-1], out=row[1:, 1:])
+
+    return row.tobytes()
+
+
+def get_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+    )
+
+
+def encode(img, dither=False, level=COMPRESS_LEVEL, strategy=COMPRESS_STRATEGY):
+    if img.mode != "L":
+        img = img.convert("L")
+
+    width, height = img.size
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, STRATEGY_MAP[strategy])
+    data = compressor.compress(pack_4bit(quantize(img, dither))) + compressor.flush()
+
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            # NOTE: bit depth 4, color type 0 (グレースケール)
+            get_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 4, 0, 0, 0, 0)),
+            get_chunk(b"IDAT", data),
+            get_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def encode_pil(img):
+    png = io.BytesIO()
+    img.save(png, "PNG")
+
+    return png.getvalue()
+
+
+def benchmark(name, func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        png = func()
+    elapsed = (time.perf_counter() - start) / count
+
+    print(
+        "{name:<24s}: {size:7,d} bytes, {elapsed:6.2f} msec".format(
+            name=name, size=len(png), elapsed=elapsed * 1000
+        )
+    )
+
+    return png
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    img = PIL.Image.open(args["-i"]).convert("L")
+    count = int(args["-n"])
+
+    benchmark("PIL 8bit", lambda: encode_pil(img), count)
+    for strategy in STRATEGY_MAP.keys():
+        for level in [1, 6, 9]:
+            benchmark(
+                "4bit {strategy} {level}".format(strategy=strategy, level=level),
+                lambda: encode(img, False, level, strategy),
+                count,
+            )
+    benchmark("4bit RLE 1 (dither)", lambda: encode(img, True), count)
+    png = benchmark("4bit RLE 1", lambda: encode(img), count)
+
+    if args["-o"] is not None:
+        with open(args["-o"], "wb") as f:
+            f.write(png)
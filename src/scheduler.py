@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import time
+import logging
+
+POLICY_SKIP = "skip"
+POLICY_CATCHUP = "catchup"
+
+JITTER_HISTORY = 60
+
+
+# NOTE: 更新時刻を，時計の上で INTERVAL の倍数の時刻 (INTERVAL が 60 なら毎分 0 秒)
+# に揃える．前回の実行時刻からの相対で決めないので，処理時間が長くてもずれが溜まらない．
+# (例えば，1分間隔更新だとして，1分40秒に更新されると，2分40秒まで更新されないので
+# 2分45秒くらいに表示を見た人は本当に1分間隔で更新されているのか心配になる)
+class TickScheduler:
+    def __init__(self, interval_sec, policy=POLICY_SKIP):
+        if policy not in [POLICY_SKIP, POLICY_CATCHUP]:
+            raise ValueError("Unknown policy: {policy}".format(policy=policy))
+
+        self.interval_sec = interval_sec
+        self.policy = policy
+        self.tick = None
+        self.miss_count = 0
+        self.jitter_list = collections.deque(maxlen=JITTER_HISTORY)
+
+    def get_tick_before(self, now):
+        return (now // self.interval_sec) * self.interval_sec
+
+    def next(self):
+        now = time.time()
+
+        if self.tick is None:
+            # NOTE: 起動直後はすぐに表示する
+            self.tick = now
+            return self.tick
+
+        tick = self.get_tick_before(self.tick) + self.interval_sec
+        if tick < now:
+            # NOTE: 処理が間に合わずに更新時刻を過ぎてしまった場合，catchup なら
+            # 過ぎた中で最新の時刻のものをすぐに表示し，skip ならその時刻は諦める
+            missed_tick = self.get_tick_before(now)
+            miss_count = int((missed_tick - tick) // self.interval_sec) + 1
+
+            if self.policy == POLICY_CATCHUP:
+                miss_count -= 1
+                tick = missed_tick
+            else:
+                tick = missed_tick + self.interval_sec
+
+            self.miss_count += miss_count
+            logging.warning(
+                "Missed {count} tick(s) (policy: {policy})".format(
+                    count=miss_count, policy=self.policy
+                )
+            )
+
+        self.tick = tick
+
+        return self.tick
+
+    def wait_until(self, target_time):
+        # NOTE: 待っている間に時計が補正されても影響を受けないように，
+        # 待ち時間をモノトニッククロック上の期限に変換して待つ
+        deadline = time.monotonic() + (target_time - time.time())
+
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            return
+
+        logging.info("sleep {remain:.1f} sec...".format(remain=remain))
+        while remain > 0:
+            time.sleep(remain)
+            remain = deadline - time.monotonic()
+
+    def report(self, actual_time):
+        jitter = actual_time - self.tick
+        self.jitter_list.append(jitter)
+
+        logging.info(
+            "Tick jitter: {jitter:+.3f} sec (mean: {mean:+.3f}, max: {max:+.3f}, missed: {miss})".format(
+                jitter=jitter,
+                mean=sum(self.jitter_list) / len(self.jitter_list),
+                max=max(self.jitter_list, key=abs),
+                miss=self.miss_count,
+            )
+        )
+
+        return jitter
@@ -4,25 +4,65 @@
 InfluxDB から電子機器の使用時間を取得します．
 
 Usage:
-  sensor_data.py [-c CONFIG]  [-e EVERY] [-w WINDOW]
+  sensor_data.py [-c CONFIG]  [-e EVERY] [-w WINDOW] [-m MODE]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
   -e EVERY     : 何分ごとのデータを取得するか [default: 1]
   -w WINDOWE   : 算出に使うウィンドウ [default: 5]
+  -m MODE      : 使用時間の算出方法 (stream, array, flux) [default: stream]
 """
 
 from docopt import docopt
 
 import influxdb_client
+import numpy as np
 import datetime
 import os
+import re
+import csv
+import codecs
+import itertools
+import collections
+import atexit
+import threading
 import logging
 import traceback
 
+from influxdb_client.client.util.date_utils import get_date_helper
+
+import series_store
+
+CLIENT_TIMEOUT_MSEC = 10000
+CLIENT_POOL_MAXSIZE = 4
+CLIENT_RETRY_COUNT = 1
+
+# NOTE: 差分取得時に，置き換える区間の前に余分に遡るウィンドウの数
+SERIES_CACHE_OVERLAP = 2
+
+PERIOD_PATTERN = r"(\d+)(mo|ms|us|µs|ns|y|w|d|h|m|s)"
+PERIOD_UNIT_MAP = {
+    "w": datetime.timedelta(weeks=1),
+    "d": datetime.timedelta(days=1),
+    "h": datetime.timedelta(hours=1),
+    "m": datetime.timedelta(minutes=1),
+    "s": datetime.timedelta(seconds=1),
+    "ms": datetime.timedelta(milliseconds=1),
+    "us": datetime.timedelta(microseconds=1),
+    "µs": datetime.timedelta(microseconds=1),
+    "ns": datetime.timedelta(microseconds=0.001),
+}
+RECORD_MAX_FALLBACK = 2**31 - 1
+
+# NOTE: FluxTable/FluxRecord を組み立てずに，CSV を受信しながら順に処理する
+CSV_DIALECT = influxdb_client.Dialect(header=True, annotations=[])
+STREAM_CHUNK_SIZE = 1024
+
+LOCALTIME_OFFSET = np.timedelta64(9, "h")
+
 FLUX_QUERY = """
 from(bucket: "{bucket}")
-|> range(start: -{period})
+|> range(start: {start})
     |> filter(fn:(r) => r._measurement == "{measure}")
     |> filter(fn: (r) => r.hostname == "{hostname}")
     |> filter(fn: (r) => r["_field"] == "{field}")
@@ -33,7 +73,7 @@ from(bucket: "{bucket}")
 
 FLUX_SUM_QUERY = """
 from(bucket: "{bucket}")
-    |> range(start: -{period})
+    |> range(start: {start})
     |> filter(fn:(r) => r._measurement == "{measure}")
     |> filter(fn: (r) => r.hostname == "{hostname}")
     |> filter(fn: (r) => r["_field"] == "{field}")
@@ -43,6 +83,58 @@ from(bucket: "{bucket}")
     )
 """
 
+FLUX_RAW_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: {start})
+    |> filter(fn:(r) => r._measurement == "{measure}")
+    |> filter(fn: (r) => r.hostname == "{hostname}")
+    |> filter(fn: (r) => r["_field"] == "{field}")
+    |> aggregateWindow(every: {every}m, fn: mean, createEmpty: {create_empty})
+    |> fill(usePrevious: true)
+"""
+
+FLUX_BATCH_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: -{window}m)
+    |> filter(fn: (r) => {target_filter})
+    |> mean()
+"""
+
+FLUX_BATCH_LAST_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: -{period})
+    |> filter(fn: (r) => {target_filter})
+    |> last()
+"""
+
+# NOTE: 閾値以上の件数だけをサーバ側で数える．timedMovingAverage で末尾に入る
+# 余分なデータは，tail の offset で取り除く
+FLUX_ON_COUNT_FILTER = """    |> tail(n: {record_max}, offset: {tail_num})
+    |> filter(fn: (r) => r._value >= {threshold})
+    |> count()
+"""
+
+FLUX_ON_COUNT_QUERY = FLUX_QUERY + FLUX_ON_COUNT_FILTER
+
+FLUX_ON_COUNT_BATCH_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: -{period})
+    |> filter(fn: (r) => {target_filter})
+    |> aggregateWindow(every: {window}m, fn: mean, createEmpty: {create_empty})
+    |> fill(usePrevious: true)
+    |> timedMovingAverage(every: {every}m, period: {window}m)
+""" + FLUX_ON_COUNT_FILTER
+
+ON_COUNT_MODE_STREAM = "stream"
+ON_COUNT_MODE_ARRAY = "array"
+ON_COUNT_MODE_FLUX = "flux"
+
+client_pool = {}
+client_pool_lock = threading.Lock()
+
+series_cache = {}
+series_cache_lock = threading.Lock()
+
 
 def fetch_data_impl(
     db_config,
@@ -51,20 +143,20 @@ def fetch_data_impl(
     hostname,
     field,
     period,
-    every,
-    window,
-    create_empty,
-    last,
+    every=1,
+    window=5,
+    create_empty=True,
+    last=False,
+    start=None,
+    is_stream=False,
 ):
     try:
-        token = os.environ.get("INFLUXDB_TOKEN", db_config["token"])
-
         query = template.format(
             bucket=db_config["bucket"],
             measure=measure,
             hostname=hostname,
             field=field,
-            period=period,
+            start="-{period}".format(period=period) if start is None else start,
             every=every,
             window=window,
             create_empty=str(create_empty).lower(),
@@ -72,20 +164,424 @@ def fetch_data_impl(
         if last:
             query += " |> last()"
 
-        logging.debug("Flux query = {query}".format(query=query))
-        client = influxdb_client.InfluxDBClient(
-            url=db_config["url"], token=token, org=db_config["org"]
-        )
-        query_api = client.query_api()
-
-        return query_api.query(query=query)
+        return query_impl(db_config, query, is_stream)
     except Exception as e:
         logging.warning(e)
         logging.warning(traceback.format_exc())
         raise
 
 
-def fetch_data(
+def get_client_key(db_config):
+    return (
+        db_config["url"],
+        db_config["org"],
+        os.environ.get("INFLUXDB_TOKEN", db_config["token"]),
+    )
+
+
+def get_client(db_config):
+    key = get_client_key(db_config)
+
+    with client_pool_lock:
+        if key not in client_pool:
+            logging.info("Create InfluxDB client (url: {url})".format(url=key[0]))
+            # NOTE: urllib3 のコネクションプールが HTTP keep-alive で接続を使い回す
+            client_pool[key] = influxdb_client.InfluxDBClient(
+                url=key[0],
+                token=key[2],
+                org=key[1],
+                timeout=CLIENT_TIMEOUT_MSEC,
+                connection_pool_maxsize=CLIENT_POOL_MAXSIZE,
+            )
+
+        return client_pool[key]
+
+
+def reset_client(db_config):
+    key = get_client_key(db_config)
+
+    with client_pool_lock:
+        client = client_pool.pop(key, None)
+
+    if client is not None:
+        logging.info("Reset InfluxDB client (url: {url})".format(url=key[0]))
+        try:
+            client.close()
+        except:
+            logging.warning(traceback.format_exc())
+
+
+def close_client():
+    with client_pool_lock:
+        client_list = list(client_pool.values())
+        client_pool.clear()
+
+    for client in client_list:
+        try:
+            client.close()
+        except:
+            logging.warning(traceback.format_exc())
+
+
+atexit.register(close_client)
+
+
+def query_impl(db_config, query, is_stream=False):
+    logging.debug("Flux query = {query}".format(query=query))
+
+    for i in range(CLIENT_RETRY_COUNT + 1):
+        try:
+            query_api = get_client(db_config).query_api()
+            if is_stream:
+                return iter_csv_row(
+                    query_api.query_raw(query=query, dialect=CSV_DIALECT)
+                )
+            else:
+                return query_api.query(query=query)
+        except influxdb_client.rest.ApiException:
+            raise
+        except:
+            # NOTE: サーバ側で切断された keep-alive 接続を掴んでいる可能性があるので，
+            # クライアントを作り直して再試行する
+            reset_client(db_config)
+            if i == CLIENT_RETRY_COUNT:
+                raise
+            logging.warning("Failed to query, retry with new client")
+
+
+def parse_period(period):
+    # NOTE: Flux の duration (例: 1w2d, 30h, 500ms) を timedelta にする．
+    # mo と y は暦によって長さが変わるので扱わない
+    token_list = re.findall(PERIOD_PATTERN, period)
+    if (len(token_list) == 0) or (
+        "".join(num + unit for num, unit in token_list) != period
+    ):
+        raise ValueError("Invalid period: {period}".format(period=period))
+
+    delta = datetime.timedelta()
+    for num, unit in token_list:
+        if unit not in PERIOD_UNIT_MAP:
+            raise ValueError(
+                "Period with calendar unit is not supported: {period}".format(
+                    period=period
+                )
+            )
+        delta += int(num) * PERIOD_UNIT_MAP[unit]
+
+    return delta
+
+
+def format_flux_time(time):
+    return np.datetime_as_string(time.astype("datetime64[s]"), unit="s") + "Z"
+
+
+def check_csv_error(reader, header):
+    # NOTE: クエリの途中で発生したエラーは，空行の後に error 列を持つテーブルとして返る
+    if "error" not in header:
+        return
+
+    row = next(reader, [])
+    message = row[header.index("error")] if len(row) > header.index("error") else ""
+
+    raise RuntimeError("Flux query failed: {message}".format(message=message))
+
+
+def iter_csv_row(response):
+    # NOTE: 受信したそばから CSV を 1 行ずつ読み，最初のテーブルの (_time, _value) を
+    # 文字列のまま返す．値が空の行は "" になる
+    is_complete = False
+    try:
+        reader = csv.reader(codecs.iterdecode(response, "utf-8"))
+
+        header = next(reader, [])
+        check_csv_error(reader, header)
+
+        if "table" in header:
+            table_index = header.index("table")
+            time_index = header.index("_time")
+            value_index = header.index("_value")
+
+            table = None
+            for row in reader:
+                # NOTE: 列構成の異なるテーブルは空行とヘッダで区切られるので，
+                # 空行かテーブル番号が変わったところで終わる
+                if len(row) == 0:
+                    check_csv_error(reader, next(reader, []))
+                    break
+                if table is None:
+                    table = row[table_index]
+                elif row[table_index] != table:
+                    break
+
+                yield (row[time_index], row[value_index])
+
+        # NOTE: 残りのテーブルは使わないが，エラーが含まれていないかは確認する
+        for row in reader:
+            if len(row) == 0:
+                check_csv_error(reader, next(reader, []))
+
+        is_complete = True
+    finally:
+        if is_complete:
+            response.drain_conn()
+            response.release_conn()
+        else:
+            # NOTE: 読み残しがあると接続を使い回せないので，途中で止めた場合は閉じる
+            response.close()
+
+
+def drop_tail(iterable, num):
+    # NOTE: 末尾の num 個を捨てる．全体の長さが分からなくても，num 個遅らせて流せばよい
+    lag = collections.deque()
+    for item in iterable:
+        lag.append(item)
+        if len(lag) > num:
+            yield lag.popleft()
+
+
+def convert_row_array(row_list):
+    if len(row_list) == 0:
+        return (np.empty(0, dtype="datetime64[s]"), np.empty(0, dtype=np.float64))
+
+    table = np.array(row_list, dtype=str)
+
+    time = (
+        np.char.rstrip(table[:, 0], "Z")
+        .astype("datetime64[ns]")
+        .astype("datetime64[s]")
+    )
+    value = np.where(table[:, 1] == "", "nan", table[:, 1]).astype(np.float64)
+
+    return (time, value)
+
+
+def read_stream_array(row_iter):
+    # NOTE: STREAM_CHUNK_SIZE 行ずつまとめて，datetime64 (UTC) と float64 の配列に変換する．
+    # 値が空の行は NaN になる
+    chunk_list = []
+    while True:
+        chunk = convert_row_array(list(itertools.islice(row_iter, STREAM_CHUNK_SIZE)))
+        if len(chunk[0]) == 0:
+            break
+        chunk_list.append(chunk)
+
+    if len(chunk_list) == 0:
+        return convert_row_array([])
+
+    return (
+        np.concatenate([chunk[0] for chunk in chunk_list]),
+        np.concatenate([chunk[1] for chunk in chunk_list]),
+    )
+
+
+def fill_previous(value, prev_value):
+    # NOTE: NaN を直前の有効な値で埋める．先頭の NaN は prev_value の最後の有効な値で埋める
+    prev_valid = prev_value[~np.isnan(prev_value)]
+    if len(prev_valid) != 0:
+        value = np.concatenate(([prev_valid[-1]], value))
+
+    index = np.where(~np.isnan(value), np.arange(len(value)), 0)
+    np.maximum.accumulate(index, out=index)
+    value = value[index]
+
+    return value[1:] if len(prev_valid) != 0 else value
+
+
+def get_series_entry(key):
+    with series_cache_lock:
+        if key not in series_cache:
+            series_cache[key] = {
+                "lock": threading.Lock(),
+                "time": np.empty(0, dtype="datetime64[s]"),
+                "value": np.empty(0, dtype=np.float64),
+                "is_loaded": False,
+            }
+
+        return series_cache[key]
+
+
+def fetch_series(
+    db_config,
+    template,
+    measure,
+    hostname,
+    field,
+    period,
+    every_min,
+    window_min,
+    create_empty,
+    tail_num=0,
+):
+    # NOTE: 系列ごとに取得済みのデータを保持しておき，2 回目以降は前回の末尾以降の
+    # 差分だけを取得する．時刻 (datetime64, UTC) と値 (float64) の配列を返す．
+    # 保持するデータは period で切り詰めるので，period ごとに別の系列として扱う
+    try:
+        period_sec = int(parse_period(period).total_seconds())
+    except ValueError:
+        # NOTE: mo や y のように長さが決まらない period は保持するデータを
+        # 切り詰められないので，キャッシュを使わずに全体を取得する
+        logging.info("Series cache: bypass for period {period}".format(period=period))
+        return read_stream_array(
+            drop_tail(
+                fetch_data_impl(
+                    db_config,
+                    template,
+                    measure,
+                    hostname,
+                    field,
+                    period,
+                    every_min,
+                    window_min,
+                    create_empty,
+                    is_stream=True,
+                ),
+                tail_num,
+            )
+        )
+
+    key = (
+        template,
+        db_config["bucket"],
+        measure,
+        hostname,
+        field,
+        period,
+        int(every_min),
+        int(window_min),
+        create_empty,
+    )
+    entry = get_series_entry(key)
+    store_path = db_config.get("store_path")
+
+    with entry["lock"]:
+        now = np.datetime64(
+            datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None), "s"
+        )
+        cutoff = now - np.timedelta64(period_sec, "s")
+
+        if (store_path is not None) and not entry["is_loaded"]:
+            # NOTE: 起動直後は前回までに保存しておいたデータから始めて，
+            # 停止していた間の差分だけを取得する
+            entry["is_loaded"] = True
+            try:
+                entry["time"], entry["value"] = series_store.get_store(store_path).load(
+                    key, cutoff
+                )
+                logging.info(
+                    "Series store: loaded {count} points".format(
+                        count=len(entry["time"])
+                    )
+                )
+            except Exception:
+                logging.warning(traceback.format_exc())
+
+        time = entry["time"]
+        value = entry["value"]
+
+        if (len(time) == 0) or (time[-1] < cutoff):
+            start = None
+            replace_from = None
+        else:
+            # NOTE: 末尾付近の値は集計途中のものなので，取得し直して置き換える．
+            # 置き換える区間の値が正しく計算されるように，移動平均のウィンドウ分
+            # だけ余分に遡り，aggregateWindow の区切りに揃えて取得する
+            window_sec = int(window_min) * 60
+            replace_from = time[-1] - np.timedelta64(window_sec, "s")
+            start_sec = (
+                replace_from.astype(np.int64)
+                - (SERIES_CACHE_OVERLAP * int(window_min) + int(every_min)) * 60
+            )
+            start = format_flux_time(
+                np.datetime64(int(start_sec // window_sec) * window_sec, "s")
+            )
+
+        fetch_time, fetch_value = read_stream_array(
+            drop_tail(
+                fetch_data_impl(
+                    db_config,
+                    template,
+                    measure,
+                    hostname,
+                    field,
+                    period,
+                    every_min,
+                    window_min,
+                    create_empty,
+                    start=start,
+                    is_stream=True,
+                ),
+                tail_num,
+            )
+        )
+
+        if replace_from is None:
+            time = fetch_time
+            value = fetch_value
+        else:
+            keep = time < replace_from
+            fetch = fetch_time >= replace_from
+            fetch_time = fetch_time[fetch]
+            fetch_value = fetch_value[fetch]
+            if "fill(usePrevious: true)" in template:
+                # NOTE: 差分の取得範囲にデータが無いと，fill(usePrevious: true) で
+                # 引き継ぐ値が無く先頭が None になるので，保持している最後の値で埋める
+                fetch_value = fill_previous(fetch_value, value[keep])
+            time = np.concatenate((time[keep], fetch_time))
+            value = np.concatenate((value[keep], fetch_value))
+
+        keep = time >= cutoff
+        time = time[keep]
+        value = value[keep]
+
+        entry["time"] = time
+        entry["value"] = value
+
+        if store_path is not None:
+            # NOTE: 保存に失敗しても，メモリ上のデータで表示は続けられる
+            try:
+                if replace_from is None:
+                    series_store.get_store(store_path).save(
+                        key, time, value, None, cutoff
+                    )
+                else:
+                    series_store.get_store(store_path).save(
+                        key, fetch_time, fetch_value, replace_from, cutoff
+                    )
+            except Exception:
+                logging.warning(traceback.format_exc())
+
+        logging.info(
+            "Series cache: fetched {fetched} points, hold {hold} points".format(
+                fetched=len(fetch_time), hold=len(time)
+            )
+        )
+
+        return (time, value)
+
+
+def get_tail_num(every_min, window_min, create_empty):
+    # NOTE: aggregateWindow(createEmpty: true) と timedMovingAverage を使うと，
+    # 末尾に余分なデータが入るので，その件数を返す
+    if create_empty and (int(window_min) > int(every_min)):
+        return int(window_min) - int(every_min)
+    else:
+        return 0
+
+
+def get_record_max(period, every_min, window_min):
+    # NOTE: tail で全件を残すための上限なので，実際の件数より十分大きければよい
+    try:
+        period_sec = int(parse_period(period).total_seconds())
+    except ValueError:
+        # NOTE: 長さが決まらない period は，十分大きな上限で代用する
+        return RECORD_MAX_FALLBACK
+
+    return 2 * (
+        period_sec // (int(every_min) * 60) + int(window_min) // int(every_min) + 1
+    )
+
+
+def fetch_data_array(
     db_config,
     measure,
     hostname,
@@ -96,6 +592,8 @@ def fetch_data(
     create_empty=True,
     last=False,
 ):
+    # NOTE: fetch_data と同じデータを，時刻 (datetime64, 日本時間) と値 (float64) の
+    # 配列で返す
     logging.info(
         (
             "Fetch data (measure: {measure}, host: {host}, field: {field}, "
@@ -114,9 +612,81 @@ def fetch_data(
     )
 
     try:
-        table_list = fetch_data_impl(
+        if last:
+            time, value = read_stream_array(
+                fetch_data_impl(
+                    db_config,
+                    FLUX_QUERY,
+                    measure,
+                    hostname,
+                    field,
+                    period,
+                    every_min,
+                    window_min,
+                    create_empty,
+                    last,
+                    is_stream=True,
+                )
+            )
+        else:
+            time, value = fetch_series(
+                db_config,
+                FLUX_QUERY,
+                measure,
+                hostname,
+                field,
+                period,
+                every_min,
+                window_min,
+                create_empty,
+                get_tail_num(every_min, window_min, create_empty),
+            )
+
+        # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
+        # だとタイミングによって，先頭に None が入る
+        valid = ~np.isnan(value)
+        time = time[valid] + LOCALTIME_OFFSET
+        value = value[valid]
+
+        logging.info("data count = {count}".format(count=len(time)))
+
+        return {"value": value, "time": time, "valid": len(time) != 0}
+    except:
+        logging.warning(traceback.format_exc())
+
+        return {
+            "value": np.empty(0, dtype=np.float64),
+            "time": np.empty(0, dtype="datetime64[s]"),
+            "valid": False,
+        }
+
+
+def to_list_data(data):
+    # NOTE: fetch_data_array の結果を，従来の fetch_data と同じリストの形式にする
+    return {
+        "value": data["value"].tolist(),
+        "time": [
+            time.replace(tzinfo=datetime.timezone.utc)
+            for time in data["time"].astype(object)
+        ],
+        "valid": data["valid"],
+    }
+
+
+def fetch_data(
+    db_config,
+    measure,
+    hostname,
+    field,
+    period="30h",
+    every_min=1,
+    window_min=5,
+    create_empty=True,
+    last=False,
+):
+    return to_list_data(
+        fetch_data_array(
             db_config,
-            FLUX_QUERY,
             measure,
             hostname,
             field,
@@ -126,36 +696,151 @@ def fetch_data(
             create_empty,
             last,
         )
-        data = []
-        time = []
-        localtime_offset = datetime.timedelta(hours=9)
+    )
 
-        if len(table_list) != 0:
-            for record in table_list[0].records:
-                # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
-                # だとタイミングによって，先頭に None が入る
-                if record.get_value() is None:
-                    logging.info("DELETE")
-                    continue
-                data.append(record.get_value())
-                time.append(record.get_time() + localtime_offset)
-
-        if create_empty and not last:
-            # NOTE: aggregateWindow(createEmpty: true) と timedMovingAverage を使うと，
-            # 末尾に余分なデータが入るので取り除く
-            every_min = int(every_min)
-            window_min = int(window_min)
-            if window_min > every_min:
-                data = data[: (every_min - window_min)]
-                time = time[: (every_min - window_min)]
 
-        logging.info("data count = {count}".format(count=len(time)))
+def build_target_filter(target_list):
+    return " or ".join(
+        map(
+            lambda target: (
+                '(r._measurement == "{measure}" and r.hostname == "{hostname}" '
+                + 'and r["_field"] == "{field}")'
+            ).format(
+                measure=target["measure"],
+                hostname=target["hostname"],
+                field=target["field"],
+            ),
+            target_list,
+        )
+    )
+
+
+def get_batch_data_map(table_list):
+    data_map = {}
+    for table in table_list:
+        for record in table.records:
+            if record.get_value() is None:
+                continue
+            key = (
+                record.get_measurement(),
+                record.values["hostname"],
+                record.get_field(),
+            )
+            data_map[key] = record.get_value()
+
+    return data_map
+
+
+def fetch_last_data_batch(db_config, target_list, window_min=5, period="1h"):
+    logging.info(
+        (
+            "Fetch last data in batch (target: {count}, window: {window}min, "
+            + "period: {period})"
+        ).format(
+            count=len(target_list),
+            window=window_min,
+            period=period,
+        )
+    )
+
+    # NOTE: 全ての (measure, hostname, field) を 1 回のクエリで取得し，
+    # ホスト毎に振り分ける
+    data_map = {}
+    if len(target_list) == 0:
+        return data_map
+
+    try:
+        query = FLUX_BATCH_QUERY.format(
+            bucket=db_config["bucket"],
+            target_filter=build_target_filter(target_list),
+            window=window_min,
+        )
+        data_map = get_batch_data_map(query_impl(db_config, query))
+
+        # NOTE: window_min より間隔を空けて送ってくるセンサーは直近の平均が無いので，
+        # period 以内の最後の値を表示する
+        missing_list = [
+            target
+            for target in target_list
+            if (target["measure"], target["hostname"], target["field"]) not in data_map
+        ]
+        if len(missing_list) != 0:
+            query = FLUX_BATCH_LAST_QUERY.format(
+                bucket=db_config["bucket"],
+                target_filter=build_target_filter(missing_list),
+                period=period,
+            )
+            data_map.update(get_batch_data_map(query_impl(db_config, query)))
+
+        logging.info("data count = {count}".format(count=len(data_map)))
+    except:
+        logging.warning(traceback.format_exc())
+
+    return data_map
+
+
+def fetch_window_mean(
+    db_config,
+    measure,
+    hostname,
+    field,
+    window_min_list,
+    every_min=1,
+):
+    logging.info(
+        (
+            "Fetch window mean (measure: {measure}, host: {host}, field: {field}, "
+            + "window: {window}min, every: {every}min)"
+        ).format(
+            measure=measure,
+            host=hostname,
+            field=field,
+            window=",".join(map(str, window_min_list)),
+            every=every_min,
+        )
+    )
+
+    mean_map = {window_min: None for window_min in window_min_list}
+
+    try:
+        # NOTE: 最大のウィンドウ分だけ生の系列を取得し，各ウィンドウの移動平均は
+        # 累積和を使ってまとめて算出する
+        _, value = fetch_series(
+            db_config,
+            FLUX_RAW_QUERY,
+            measure,
+            hostname,
+            field,
+            "{window}m".format(window=max(window_min_list)),
+            every_min,
+            every_min,
+            True,
+        )
+
+        if len(value) == 0:
+            return mean_map
+
+        valid = ~np.isnan(value)
+
+        value_sum = np.concatenate(([0.0], np.cumsum(np.where(valid, value, 0.0))))
+        count_sum = np.concatenate(([0], np.cumsum(valid)))
+
+        window_size = np.minimum(
+            np.array(window_min_list) // int(every_min), len(value)
+        )
+        start = len(value) - window_size
+        count = count_sum[-1] - count_sum[start]
+        total = value_sum[-1] - value_sum[start]
+
+        for i, window_min in enumerate(window_min_list):
+            if count[i] != 0:
+                mean_map[window_min] = float(total[i] / count[i])
 
-        return {"value": data, "time": time, "valid": len(time) != 0}
+        logging.info("data count = {count}".format(count=len(value)))
     except:
         logging.warning(traceback.format_exc())
 
-        return {"value": [], "time": [], "valid": False}
+    return mean_map
 
 
 def get_equip_on_minutes(
@@ -168,12 +853,17 @@ def get_equip_on_minutes(
     every_min=1,
     window_min=5,
     create_empty=True,
+    mode=ON_COUNT_MODE_STREAM,
 ):
+    # NOTE: 下の try で握りつぶされないように，先に確認する
+    if mode not in [ON_COUNT_MODE_STREAM, ON_COUNT_MODE_ARRAY, ON_COUNT_MODE_FLUX]:
+        raise ValueError("Unknown mode: {mode}".format(mode=mode))
+
     logging.info(
         (
             "Get on minutes (type: {type}, host: {host}, field: {field}, "
             + "threshold: {threshold}, period: {period}, every: {every}min, "
-            + "window: {window}min, create_empty: {create_empty})"
+            + "window: {window}min, create_empty: {create_empty}, mode: {mode})"
         ).format(
             type=measure,
             host=hostname,
@@ -183,51 +873,133 @@ def get_equip_on_minutes(
             every=every_min,
             window=window_min,
             create_empty=create_empty,
+            mode=mode,
         )
     )
 
     try:
-        table_list = fetch_data_impl(
-            config,
-            FLUX_QUERY,
-            measure,
-            hostname,
-            field,
-            period,
-            every_min,
-            window_min,
-            create_empty,
-        )
+        tail_num = get_tail_num(every_min, window_min, create_empty)
 
-        if len(table_list) == 0:
-            return 0
-
-        count = 0
+        if mode == ON_COUNT_MODE_FLUX:
+            # NOTE: 移動平均の系列は転送せず，件数だけを受け取る
+            query = FLUX_ON_COUNT_QUERY.format(
+                bucket=config["bucket"],
+                measure=measure,
+                hostname=hostname,
+                field=field,
+                start="-{period}".format(period=period),
+                every=every_min,
+                window=window_min,
+                create_empty=str(create_empty).lower(),
+                record_max=get_record_max(period, every_min, window_min),
+                tail_num=tail_num,
+                threshold=float(threshold),
+            )
+            table_list = query_impl(config, query)
 
-        every_min = int(every_min)
-        window_min = int(window_min)
-        record_num = len(table_list[0].records)
+            count = 0
+            if (len(table_list) != 0) and (len(table_list[0].records) != 0):
+                count = table_list[0].records[0].get_value()
+        else:
+            row_iter = drop_tail(
+                fetch_data_impl(
+                    config,
+                    FLUX_QUERY,
+                    measure,
+                    hostname,
+                    field,
+                    period,
+                    every_min,
+                    window_min,
+                    create_empty,
+                    is_stream=True,
+                ),
+                tail_num,
+            )
 
-        for i, record in enumerate(table_list[0].records):
-            if create_empty:
-                # NOTE: timedMovingAverage を使うと，末尾に余分なデータが入るので取り除く
-                if window_min > every_min:
-                    if i > record_num - 1 - (window_min - every_min):
+            if mode == ON_COUNT_MODE_ARRAY:
+                # NOTE: 時刻は使わないので値だけを変換する．None は NaN になり，
+                # 比較が常に偽になるので数えられない
+                value = np.array([value for _, value in row_iter], dtype=str)
+                value = np.where(value == "", "nan", value).astype(np.float64)
+                count = np.count_nonzero(value >= threshold)
+            else:
+                count = 0
+                for _, value in row_iter:
+                    # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の
+                    # 組み合わせだとタイミングによって，先頭に None が入る
+                    if value == "":
                         continue
+                    if float(value) >= threshold:
+                        count += 1
 
-            # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
-            # だとタイミングによって，先頭に None が入る
-            if record.get_value() is None:
-                continue
-            if record.get_value() >= threshold:
-                count += 1
-
-        return count * int(every_min)
+        return int(count) * int(every_min)
     except:
         logging.warning(traceback.format_exc())
         return 0
 
 
+def get_equip_on_minutes_batch(
+    config,
+    target_list,
+    threshold,
+    period="30h",
+    every_min=1,
+    window_min=5,
+    create_empty=True,
+):
+    logging.info(
+        (
+            "Get on minutes in batch (target: {count}, threshold: {threshold}, "
+            + "period: {period}, every: {every}min, window: {window}min, "
+            + "create_empty: {create_empty})"
+        ).format(
+            count=len(target_list),
+            threshold=threshold,
+            period=period,
+            every=every_min,
+            window=window_min,
+            create_empty=create_empty,
+        )
+    )
+
+    # NOTE: 全ての (measure, hostname, field) の件数を 1 回のクエリで数え，
+    # ホスト毎に振り分ける．閾値を超えなかったものは 0 になる
+    minutes_map = {
+        (target["measure"], target["hostname"], target["field"]): 0
+        for target in target_list
+    }
+    if len(target_list) == 0:
+        return minutes_map
+
+    try:
+        query = FLUX_ON_COUNT_BATCH_QUERY.format(
+            bucket=config["bucket"],
+            target_filter=build_target_filter(target_list),
+            period=period,
+            every=every_min,
+            window=window_min,
+            create_empty=str(create_empty).lower(),
+            record_max=get_record_max(period, every_min, window_min),
+            tail_num=get_tail_num(every_min, window_min, create_empty),
+            threshold=float(threshold),
+        )
+        table_list = query_impl(config, query)
+
+        for table in table_list:
+            for record in table.records:
+                key = (
+                    record.get_measurement(),
+                    record.values["hostname"],
+                    record.get_field(),
+                )
+                minutes_map[key] = int(record.get_value()) * int(every_min)
+    except:
+        logging.warning(traceback.format_exc())
+
+    return minutes_map
+
+
 def get_equip_mode_period(
     config,
     measure,
@@ -257,7 +1029,7 @@ def get_equip_mode_period(
     )
 
     try:
-        table_list = fetch_data_impl(
+        row_iter = fetch_data_impl(
             config,
             FLUX_QUERY,
             measure,
@@ -267,53 +1039,57 @@ def get_equip_mode_period(
             every_min,
             window_min,
             create_empty,
+            is_stream=True,
         )
 
-        if len(table_list) == 0:
-            return []
-
-        # NOTE: 常時冷却と間欠冷却の期間を求める
+        # NOTE: 常時冷却と間欠冷却の期間を求める．時刻の文字列は，状態が変わった
+        # ところでだけ datetime に変換する
         on_range = []
         state = "IDLE"
         start_time = None
+        last_time = None
         localtime_offset = datetime.timedelta(hours=9)
+        parse_date = get_date_helper().parse_date
+
+        for time, value in row_iter:
+            last_time = time
 
-        for record in table_list[0].records:
             # NOTE: aggregateWindow(createEmpty: true) と fill(usePrevious: true) の組み合わせ
             # だとタイミングによって，先頭に None が入る
-            if record.get_value() is None:
+            if value == "":
                 continue
+            value = float(value)
 
-            if record.get_value() > threshold["FULL"]:
+            if value > threshold["FULL"]:
                 if state != "FULL":
                     if state == "INTERM":
                         on_range.append(
                             [
                                 start_time + localtime_offset,
-                                record.get_time() + localtime_offset,
+                                parse_date(time) + localtime_offset,
                                 False,
                             ]
                         )
                     state = "FULL"
-                    start_time = record.get_time()
-            elif record.get_value() > threshold["INTERM"]:
+                    start_time = parse_date(time)
+            elif value > threshold["INTERM"]:
                 if state != "INTERM":
                     if state == "FULL":
                         on_range.append(
                             [
                                 start_time + localtime_offset,
-                                record.get_time() + localtime_offset,
+                                parse_date(time) + localtime_offset,
                                 True,
                             ]
                         )
                     state = "INTERM"
-                    start_time = record.get_time()
+                    start_time = parse_date(time)
             else:
                 if state != "IDLE":
                     on_range.append(
                         [
                             start_time + localtime_offset,
-                            record.get_time() + localtime_offset,
+                            parse_date(time) + localtime_offset,
                             state == "FULL",
                         ]
                     )
@@ -323,7 +1099,7 @@ def get_equip_mode_period(
             on_range.append(
                 [
                     start_time + localtime_offset,
-                    table_list[0].records[-1].get_time() + localtime_offset,
+                    parse_date(last_time) + localtime_offset,
                     state == "FULL",
                 ]
             )
@@ -405,6 +1181,7 @@ if __name__ == "__main__":
                 period,
                 every,
                 window,
+                mode=args["-m"],
             ),
         )
     )
@@ -4,15 +4,42 @@
 import os
 import datetime
 import pathlib
+import hashlib
+import json
+import collections
 import numpy as np
+import PIL
 import PIL.Image
 import PIL.ImageDraw
-import PIL.ImageFont
 import functools
 import logging
+import traceback
 
-from sensor_data import fetch_data
+from sensor_data import fetch_last_data_batch, fetch_window_mean
 from config import get_db_config
+from pil_util import load_font, measure_text, get_glyph_atlas, convert_to_gray_canvas
+
+# NOTE: レイアウトはこれらの設定だけから決まる
+LAYOUT_CONFIG_KEY_LIST = ["PANEL", "LAYOUT", "FONT", "ICON", "SENSOR", "POWER"]
+
+# NOTE: 数値だけを表示する大きなフォントはグリフのビットマップを使い回して描画する
+GLYPH_ATLAS_FACE_LIST = ["TEMP", "HUMI", "CO2", "POWER_LARGE", "POWER_DETAIL_VALUE"]
+GLYPH_ATLAS_CHARSET = "0123456789.,?- "
+
+# NOTE: key が None の場合は text を固定で描画し，そうでない場合は
+# 毎フレーム key に対応する値を format で整形して描画する．
+# sample はレイアウト計算時に使う代表的な文字列．
+DrawItem = collections.namedtuple(
+    "DrawItem",
+    ["face", "align", "pos", "color", "text", "key", "format", "depend", "sample"],
+    defaults=["#000", None, None, None, None, None],
+)
+IconItem = collections.namedtuple("IconItem", ["name", "pos"])
+LayoutPlan = collections.namedtuple("LayoutPlan", ["item_list", "icon_list", "height"])
+
+layout_plan_cache = {}
+static_layer_cache = {}
+icon_cache = {}
 
 
 def abs_path(path):
@@ -23,99 +50,115 @@ def get_font(config, face):
     font_config = config["FONT"]
     face_config = config["LAYOUT"]["FACE"]
 
-    font = PIL.ImageFont.truetype(
+    font = load_font(
         abs_path(font_config["PATH"] + font_config["MAP"][face_config[face]["TYPE"]]),
         face_config[face]["SIZE"],
     )
     return font
 
 
+def get_icon(config, name, mode):
+    path = abs_path(config["ICON"]["PATH"] + config["ICON"]["MAP"][name])
+
+    if (path, mode) not in icon_cache:
+        icon = PIL.Image.open(path, "r")
+        if mode == "L":
+            icon = convert_to_gray_canvas(icon)
+        icon_cache[(path, mode)] = icon
+
+    return icon_cache[(path, mode)]
+
+
 def get_unit(config, name):
-    param_list = config["SENSOR"]["PARAM_LIST"]
-    param_list.append(config["POWER"]["DATA"]["PARAM"])
+    param_list = config["SENSOR"]["PARAM_LIST"] + [config["POWER"]["DATA"]["PARAM"]]
 
     for param in param_list:
         if param["NAME"] == name:
             return param["UNIT"]
 
 
+def get_text_size(config, face, text):
+    return measure_text(get_font(config, face), text).size
+
+
+def get_item_bottom(config, item):
+    text = item.text if item.text is not None else item.sample
+
+    return item.pos[1] + get_text_size(config, item.face, text)[1]
+
+
 def draw_text(config, img, text, pos, face, align=True, color="#000"):
     draw = PIL.ImageDraw.Draw(img)
 
     font = get_font(config, face)
-    next_pos_y = pos[1] + font.getsize(text)[1]
+    size = measure_text(font, text).size
+    next_pos_y = pos[1] + size[1]
 
     if align:
         # 右寄せ
         None
     else:
         # 左寄せ
-        pos = (pos[0] - font.getsize(text)[0], pos[1])
+        pos = (pos[0] - size[0], pos[1])
+
+    if face in GLYPH_ATLAS_FACE_LIST:
+        atlas = get_glyph_atlas(font, GLYPH_ATLAS_CHARSET)
+        if atlas.can_draw(text):
+            atlas.draw(img, pos, text, color)
+            return next_pos_y
 
-    draw.text(pos, text, color, font, None, font.getsize(text)[1] * 0.4)
+    draw.text(pos, text, color, font, None, size[1] * 0.4)
 
     return next_pos_y
 
 
 ######################################################################
 class SenseLargeHeaderPanel:
-    def __init__(self, config, img, offset, width):
+    def __init__(self, config, offset, width):
         self.config = config
-        self.img = img
-        self.offset = np.array(offset)
+        self.offset = tuple(offset)
         self.width = width
-        self.power_icon = PIL.Image.open(
-            abs_path(self.config["ICON"]["PATH"] + self.config["ICON"]["MAP"]["POWER"]),
-            "r",
-        )
 
     def __get_temp_box_size(self):
-        return get_font(self.config, "TEMP_LARGE").getsize("44.4")
+        return get_text_size(self.config, "TEMP_LARGE", "44.4")
 
     def __get_temp_unit_box_size(self):
-        return get_font(self.config, "UNIT_LARGE").getsize(
-            get_unit(self.config, "temp")
-        )
+        return get_text_size(self.config, "UNIT_LARGE", get_unit(self.config, "temp"))
 
     def __get_humi_box_size(self):
-        return get_font(self.config, "HUMI_LARGE").getsize("100.0")
+        return get_text_size(self.config, "HUMI_LARGE", "100.0")
 
     def __get_humi_unit_box_size(self):
-        return get_font(self.config, "UNIT_LARGE").getsize(
-            get_unit(self.config, "humi")
-        )
+        return get_text_size(self.config, "UNIT_LARGE", get_unit(self.config, "humi"))
 
     def __get_power_box_size(self):
         # PIM が baseline を取得できないっぽいので，「,」ではなく「.」を使う
-        return get_font(self.config, "POWER_LARGE").getsize("1.000")
+        return get_text_size(self.config, "POWER_LARGE", "1.000")
 
     def __get_power_unit_box_size(self):
-        size = get_font(self.config, "UNIT_LARGE").getsize(
-            get_unit(self.config, "power")
-        )
+        size = get_text_size(self.config, "UNIT_LARGE", get_unit(self.config, "power"))
         return (int(size[0] * 1.2), size[1])
 
     def __get_power_10min_label_box_size(self):
-        return get_font(self.config, "POWER_DETAIL_LABEL").getsize("10min")
+        return get_text_size(self.config, "POWER_DETAIL_LABEL", "10min")
 
     def __get_power_60min_label_box_size(self):
-        return get_font(self.config, "POWER_DETAIL_LABEL").getsize("60min")
+        return get_text_size(self.config, "POWER_DETAIL_LABEL", "60min")
 
     def __get_power_180min_label_box_size(self):
-        return get_font(self.config, "POWER_DETAIL_LABEL").getsize("180min")
+        return get_text_size(self.config, "POWER_DETAIL_LABEL", "180min")
 
     def __get_power_detail_value_box_size(self):
-        return get_font(self.config, "POWER_DETAIL_VALUE").getsize(
-            self.__get_power_str(2444).replace(",", ".")
+        return get_text_size(
+            self.config,
+            "POWER_DETAIL_VALUE",
+            self.__get_power_str(2444).replace(",", "."),
         )
 
     def __get_power_str(self, value):
-        if value is None:
-            return "?  "
-        else:
-            return self.config["POWER"]["DATA"]["PARAM"]["FORMAT"].format(value)
+        return self.config["POWER"]["DATA"]["PARAM"]["FORMAT"].format(value)
 
-    def offset_map(self, data):
+    def offset_map(self):
         box_size = {
             "temp": self.__get_temp_box_size(),
             "temp_unit": self.__get_temp_unit_box_size(),
@@ -129,154 +172,103 @@ class SenseLargeHeaderPanel:
             "power_detail_value": self.__get_power_detail_value_box_size(),
         }
 
+        offset_x, offset_y = self.offset
+        detail_size = box_size["power_detail_value"]
+
         offset_map = {
-            "power_icon_left": self.offset + np.array([0, 10]),
-            "power_10min_value_right": self.offset + np.array([self.width, 0]),
-            "power_60min_value_right": self.offset
-            + np.array([self.width, box_size["power_detail_value"][1] + 35]),
-            "power_180min_value_right": self.offset
-            + np.array([self.width, 2 * (box_size["power_detail_value"][1] + 35)]),
+            "power_icon_left": (offset_x, offset_y + 10),
+            "power_10min_value_right": (offset_x + self.width, offset_y),
+            "power_60min_value_right": (
+                offset_x + self.width,
+                offset_y + detail_size[1] + 35,
+            ),
+            "power_180min_value_right": (
+                offset_x + self.width,
+                offset_y + 2 * (detail_size[1] + 35),
+            ),
         }
 
-        offset_map["power_10min_label_left"] = offset_map[
-            "power_10min_value_right"
-        ] + np.array(
-            [
-                -box_size["power_detail_value"][0]
-                - box_size["power_10min_label"][0]
-                - 10,
-                box_size["power_detail_value"][1] - box_size["power_10min_label"][1],
-            ]
-        )
-
-        offset_map["power_60min_label_left"] = offset_map[
-            "power_60min_value_right"
-        ] + np.array(
-            [
-                -box_size["power_detail_value"][0]
-                - box_size["power_60min_label"][0]
-                - 10,
-                box_size["power_detail_value"][1] - box_size["power_60min_label"][1],
-            ]
-        )
+        for label in ["10min", "60min", "180min"]:
+            value_right = offset_map["power_{label}_value_right".format(label=label)]
+            label_size = box_size["power_{label}_label".format(label=label)]
 
-        offset_map["power_180min_label_left"] = offset_map[
-            "power_180min_value_right"
-        ] + np.array(
-            [
-                -box_size["power_detail_value"][0]
-                - box_size["power_180min_label"][0]
-                - 10,
-                box_size["power_detail_value"][1] - box_size["power_180min_label"][1],
-            ]
-        )
+            offset_map["power_{label}_label_left".format(label=label)] = (
+                value_right[0] - detail_size[0] - label_size[0] - 10,
+                value_right[1] + detail_size[1] - label_size[1],
+            )
 
-        offset_map["power_unit_right"] = np.array(
-            [
-                offset_map["power_10min_label_left"][0] - 50,
-                offset_map["power_10min_value_right"][1]
-                + box_size["power"][1]
-                - box_size["power_unit"][1],
-            ]
+        offset_map["power_unit_right"] = (
+            offset_map["power_10min_label_left"][0] - 50,
+            offset_map["power_10min_value_right"][1]
+            + box_size["power"][1]
+            - box_size["power_unit"][1],
         )
-        offset_map["power_right"] = np.array(
-            [
-                offset_map["power_unit_right"][0] - box_size["power_unit"][1] - 10,
-                offset_map["power_10min_value_right"][1],
-            ]
+        offset_map["power_right"] = (
+            offset_map["power_unit_right"][0] - box_size["power_unit"][1] - 10,
+            offset_map["power_10min_value_right"][1],
         )
 
         return offset_map
 
-    def draw(self, data):
-        logging.info("draw header")
+    def layout(self):
+        offset_map = self.offset_map()
+        power_format = self.config["POWER"]["DATA"]["PARAM"]["FORMAT"]
 
-        offset_map = self.offset_map(data)
-        next_draw_y_list = []
+        icon_list = [IconItem("POWER", offset_map["power_icon_left"])]
+        item_list = []
 
         ############################################################
         # 電力
-        self.img.paste(self.power_icon, tuple(offset_map["power_icon_left"]))
-
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                "10min",
-                offset_map["power_10min_label_left"],
-                "POWER_DETAIL_LABEL",
-            )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                "60min",
-                offset_map["power_60min_label_left"],
-                "POWER_DETAIL_LABEL",
-            )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                "180min",
-                offset_map["power_180min_label_left"],
-                "POWER_DETAIL_LABEL",
-            )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                self.__get_power_str(data["power"]["10min"]),
-                offset_map["power_10min_value_right"],
-                "POWER_DETAIL_VALUE",
-                False,
-            )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                self.__get_power_str(data["power"]["60min"]),
-                offset_map["power_60min_value_right"],
-                "POWER_DETAIL_VALUE",
-                False,
+        for label in ["10min", "60min", "180min"]:
+            item_list.append(
+                DrawItem(
+                    "POWER_DETAIL_LABEL",
+                    "left",
+                    offset_map["power_{label}_label_left".format(label=label)],
+                    text=label,
+                )
             )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                self.__get_power_str(data["power"]["180min"]),
-                offset_map["power_180min_value_right"],
-                "POWER_DETAIL_VALUE",
-                False,
+        for label in ["10min", "60min", "180min"]:
+            item_list.append(
+                DrawItem(
+                    "POWER_DETAIL_VALUE",
+                    "right",
+                    offset_map["power_{label}_value_right".format(label=label)],
+                    key="power.{label}".format(label=label),
+                    format=power_format,
+                    sample=self.__get_power_str(2444),
+                )
             )
-        )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                get_unit(self.config, "power"),
-                offset_map["power_unit_right"],
+        item_list.append(
+            DrawItem(
                 "UNIT_LARGE",
-                False,
+                "right",
+                offset_map["power_unit_right"],
+                text=get_unit(self.config, "power"),
             )
         )
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                self.__get_power_str(data["power"]["3min"]),
-                offset_map["power_right"],
+        item_list.append(
+            DrawItem(
                 "POWER_LARGE",
-                False,
+                "right",
+                offset_map["power_right"],
+                key="power.3min",
+                format=power_format,
+                sample=self.__get_power_str(2444),
             )
         )
 
-        return int(max(next_draw_y_list) - 10)
+        # NOTE: ヘッダの高さは，実際の値ではなくサンプル ("2,444") の大きさで決まる．
+        # 以前は描画する文字列を毎回測っていたので，電力が "?" や 3 桁以下のときは
+        # ヘッダが低くなり，その下の配置が 8px 上にずれていた
+        return (
+            item_list,
+            icon_list,
+            int(
+                max(map(lambda item: get_item_bottom(self.config, item), item_list))
+                - 10
+            ),
+        )
 
 
 ######################################################################
@@ -294,10 +286,10 @@ class SenseLargeFooterPanel:
         )
 
     def __get_date_box_size(self, value):
-        return get_font("date_large").getsize("12331")
+        return get_text_size(self.config, "date_large", "12331")
 
     def __get_wday_box_size(self):
-        return get_font("wday_large").getsize("(金)")
+        return get_text_size(self.config, "wday_large", "(金)")
 
     def offset_map(self, data):
         box_size = {
@@ -351,46 +343,45 @@ class SenseLargeFooterPanel:
 
 ######################################################################
 class SenseDetailPanel:
-    def __init__(self, config, img, offset, width):
+    def __init__(self, config, offset, width):
         self.config = config
-        self.img = img
-        self.offset = np.array(offset)
+        self.offset = tuple(offset)
         self.width = width
 
     def __get_place_box_size(self):
         font = get_font(self.config, "PLACE")
-        max_size = np.array([0, 0])
+        max_size = (0, 0)
 
         for room in self.config["SENSOR"]["ROOM_LIST"]:
-            size = np.array(font.getsize(room["LABEL"]))
-            max_size = np.maximum(max_size, size)
+            size = measure_text(font, room["LABEL"]).size
+            max_size = (max(max_size[0], size[0]), max(max_size[1], size[1]))
 
-            return max_size + np.array([font.getsize(" ")[0], 0])
+        return (max_size[0] + measure_text(font, " ").size[0], max_size[1])
 
     def __get_temp_box_size(self):
-        return get_font(self.config, "TEMP").getsize("44.4")
+        return get_text_size(self.config, "TEMP", "44.4")
 
     def __get_temp_unit_box_size(self):
-        size = get_font(self.config, "UNIT").getsize(get_unit(self.config, "temp"))
+        size = get_text_size(self.config, "UNIT", get_unit(self.config, "temp"))
         return (int(size[0] * 1), size[1])
 
     def __get_humi_box_size(self):
-        return get_font(self.config, "HUMI").getsize("888.8")
+        return get_text_size(self.config, "HUMI", "888.8")
 
     def __get_humi_unit_box_size(self):
-        size = get_font(self.config, "UNIT").getsize(get_unit(self.config, "humi"))
+        size = get_text_size(self.config, "UNIT", get_unit(self.config, "humi"))
         return (int(size[0] * 1), size[1])
 
     def __get_co2_box_size(self):
         return (
-            get_font(self.config, "CO2").getsize("2,888")[0],
-            get_font(self.config, "CO2").getsize("4")[1],
+            get_text_size(self.config, "CO2", "2,888")[0],
+            get_text_size(self.config, "CO2", "4")[1],
         )
 
     def __get_co2_unit_box_size(self):
         # PIM が baseline を取得できないっぽいので，descent が無い「m」を使う
-        size = get_font(self.config, "UNIT").getsize(
-            "m" * len(get_unit(self.config, "co2"))
+        size = get_text_size(
+            self.config, "UNIT", "m" * len(get_unit(self.config, "co2"))
         )
         return (int(size[0] * 0.8), size[1])
 
@@ -419,29 +410,34 @@ class SenseDetailPanel:
             "place-left": (0, 0),
             "temp-right": (box_size["temp"][0], box_size["place"][1] * 1.2),
         }
+        line_y = offset_map["temp-right"][1]
 
-        offset_map["temp_unit-right"] = np.array(
-            [offset_map["temp-right"][0], offset_map["temp-right"][1]]
-        ) + np.array([box_size["temp_unit"][0], max_height - box_size["temp_unit"][1]])
-
-        offset_map["humi-right"] = np.array(
-            [offset_map["temp_unit-right"][0], offset_map["temp-right"][1]]
-        ) + np.array([col_gap + box_size["humi"][0], max_height - box_size["humi"][1]])
-
-        offset_map["humi_unit-right"] = np.array(
-            [offset_map["humi-right"][0], offset_map["temp-right"][1]]
-        ) + np.array([box_size["humi_unit"][0], max_height - box_size["humi_unit"][1]])
-
-        offset_map["co2-right"] = np.array(
-            [offset_map["humi_unit-right"][0], offset_map["temp-right"][1]]
-        ) + np.array([col_gap + box_size["co2"][0], max_height - box_size["co2"][1]])
-
-        offset_map["co2_unit-right"] = np.array(
-            [offset_map["co2-right"][0], offset_map["temp-right"][1]]
-        ) + np.array([box_size["co2_unit"][0], max_height - box_size["co2_unit"][1]])
+        offset_map["temp_unit-right"] = (
+            offset_map["temp-right"][0] + box_size["temp_unit"][0],
+            line_y + max_height - box_size["temp_unit"][1],
+        )
+        offset_map["humi-right"] = (
+            offset_map["temp_unit-right"][0] + col_gap + box_size["humi"][0],
+            line_y + max_height - box_size["humi"][1],
+        )
+        offset_map["humi_unit-right"] = (
+            offset_map["humi-right"][0] + box_size["humi_unit"][0],
+            line_y + max_height - box_size["humi_unit"][1],
+        )
+        offset_map["co2-right"] = (
+            offset_map["humi_unit-right"][0] + col_gap + box_size["co2"][0],
+            line_y + max_height - box_size["co2"][1],
+        )
+        offset_map["co2_unit-right"] = (
+            offset_map["co2-right"][0] + box_size["co2_unit"][0],
+            line_y + max_height - box_size["co2_unit"][1],
+        )
 
         for key in offset_map.keys():
-            offset_map[key] += self.offset
+            offset_map[key] = (
+                offset_map[key][0] + self.offset[0],
+                offset_map[key][1] + self.offset[1],
+            )
 
         offset_map["line_height"] = box_size["place"][1] + max_height * 1.40
 
@@ -453,157 +449,320 @@ class SenseDetailPanel:
                 return param["FORMAT"]
         return "{}"
 
-    def get_formatted_value(self, data, key):
-        if (key in data) and (data[key] is not None):
-            return self.get_format(key).format((data[key]))
-        else:
-            return "?  "
+    def layout(self):
+        offset_map = self.offset_map()
+        item_list = []
 
-    def draw(self, data_list):
-        logging.info("draw detail")
+        sample_map = {"temp": "44.4", "humi": "888.8", "co2": "2,888"}
 
-        offset_map = self.offset_map()
-        next_draw_y_list = []
+        for i, room in enumerate(self.config["SENSOR"]["ROOM_LIST"]):
+            line_offset = offset_map["line_height"] * i
 
-        i = 0
-        for data in data_list:
-            line_offset = np.array([0, (offset_map["line_height"] * i)])
-            next_draw_y_list.append(
-                draw_text(
-                    self.config,
-                    self.img,
-                    data["place"],
-                    offset_map["place-left"] + line_offset,
-                    "PLACE",
-                )
-            )
+            def line_pos(name):
+                return (offset_map[name][0], offset_map[name][1] + line_offset)
 
-            next_draw_y_list.append(
-                draw_text(
-                    self.config,
-                    self.img,
-                    self.get_formatted_value(data, "temp"),
-                    offset_map["temp-right"] + line_offset,
-                    "TEMP",
-                    False,
-                )
+            item_list.append(
+                DrawItem("PLACE", "left", line_pos("place-left"), text=room["LABEL"])
             )
-            next_draw_y_list.append(
-                draw_text(
-                    self.config,
-                    self.img,
-                    get_unit(self.config, "temp"),
-                    offset_map["temp_unit-right"] + line_offset,
-                    "UNIT",
-                    False,
-                )
-            )
-            next_draw_y_list.append(
-                draw_text(
-                    self.config,
-                    self.img,
-                    self.get_formatted_value(data, "humi"),
-                    offset_map["humi-right"] + line_offset,
-                    "HUMI",
-                    False,
-                )
-            )
-            next_draw_y_list.append(
-                draw_text(
-                    self.config,
-                    self.img,
-                    get_unit(self.config, "humi"),
-                    offset_map["humi_unit-right"] + line_offset,
-                    "UNIT",
-                    False,
-                )
-            )
-            if "co2" in data:
-                next_draw_y_list.append(
-                    draw_text(
-                        self.config,
-                        self.img,
-                        self.get_formatted_value(data, "co2"),
-                        offset_map["co2-right"] + line_offset,
-                        "CO2",
-                        False,
+
+            for param in ["temp", "humi", "co2"]:
+                key = "room.{index}.{param}".format(index=i, param=param)
+                # NOTE: CO2 はセンサが無い部屋もあるので，値がある場合のみ描画する
+                depend = key if param == "co2" else None
+
+                item_list.append(
+                    DrawItem(
+                        param.upper(),
+                        "right",
+                        line_pos(param + "-right"),
+                        key=key,
+                        format=self.get_format(param),
+                        depend=depend,
+                        sample=sample_map[param],
                     )
                 )
-                next_draw_y_list.append(
-                    draw_text(
-                        self.config,
-                        self.img,
-                        get_unit(self.config, "co2"),
-                        offset_map["co2_unit-right"] + line_offset,
+                item_list.append(
+                    DrawItem(
                         "UNIT",
-                        False,
+                        "right",
+                        line_pos(param + "_unit-right"),
+                        text=get_unit(self.config, param),
+                        depend=depend,
                     )
                 )
-            i += 1
 
-        return int(max(next_draw_y_list)) + 30
+        return (
+            item_list,
+            [],
+            int(max(map(lambda item: get_item_bottom(self.config, item), item_list)))
+            + 30,
+        )
 
 
 ######################################################################
 class UpdateTimePanel:
-    def __init__(self, config, img, offset, width):
+    def __init__(self, config, offset, width):
         self.config = config
-        self.img = img
-        self.offset = np.array(offset)
+        self.offset = tuple(offset)
         self.width = width
 
-    def __get_time_box_size(self):
-        return get_font(self.config, "TIME").getsize(
-            "{0:%Y-%m-%d %H:%M} 更新".format(datetime.datetime.now())
+    def offset_map(self):
+        suffix_width = (
+            get_text_size(self.config, "TIME", "更新")[0]
+            + measure_text(get_font(self.config, "TIME"), " ").advance
         )
 
-    def offset_map(self, data):
         return {
-            "time_right": self.offset + np.array([self.width, -20]),
+            "time_suffix_right": (self.offset[0] + self.width, self.offset[1] - 20),
+            "time_right": (
+                self.offset[0] + self.width - suffix_width,
+                self.offset[1] - 20,
+            ),
         }
 
-    def draw(self, data):
-        logging.info("draw update time")
-
-        offset_map = self.offset_map(data)
-        next_draw_y_list = []
+    def layout(self):
+        offset_map = self.offset_map()
 
-        next_draw_y_list.append(
-            draw_text(
-                self.config,
-                self.img,
-                "{0:%Y-%m-%d %H:%M} 更新".format(data["date"]),
-                offset_map["time_right"],
+        # NOTE: 「更新」は固定なので，日時とは分けて描画する
+        item_list = [
+            DrawItem(
                 "TIME",
-                False,
+                "right",
+                offset_map["time_right"],
                 "#666",
-            )
+                key="time",
+                format="{0:%Y-%m-%d %H:%M}",
+                sample="{0:%Y-%m-%d %H:%M}".format(datetime.datetime(2000, 1, 1)),
+            ),
+            DrawItem(
+                "TIME", "right", offset_map["time_suffix_right"], "#666", text="更新"
+            ),
+        ]
+
+        return (
+            item_list,
+            [],
+            int(max(map(lambda item: get_item_bottom(self.config, item), item_list)))
+            + 40,
         )
 
-        return int(max(next_draw_y_list)) + 40
+
+######################################################################
+def get_layout_key(config):
+    layout_config = {key: config.get(key) for key in LAYOUT_CONFIG_KEY_LIST}
+    layout_config["PIL"] = PIL.__version__
+
+    return hashlib.sha256(
+        json.dumps(layout_config, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def get_layout_cache_path(config, layout_key):
+    if ("CACHE" not in config["LAYOUT"]) or ("PATH" not in config["LAYOUT"]["CACHE"]):
+        return None
+
+    return pathlib.Path(config["LAYOUT"]["CACHE"]["PATH"]) / (
+        "layout_{key}.json".format(key=layout_key[:16])
+    )
+
+
+def load_layout_plan(path):
+    try:
+        with open(path, "r") as file:
+            plan = json.load(file)
+
+        return LayoutPlan(
+            tuple(
+                map(
+                    lambda item: DrawItem(*item[:2], tuple(item[2]), *item[3:]),
+                    plan["item_list"],
+                )
+            ),
+            tuple(
+                map(lambda item: IconItem(item[0], tuple(item[1])), plan["icon_list"])
+            ),
+            plan["height"],
+        )
+    except:
+        logging.warning(traceback.format_exc())
+        return None
+
+
+def save_layout_plan(path, plan):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(plan._asdict(), file, ensure_ascii=False)
+    except:
+        logging.warning(traceback.format_exc())
+
+
+def compile_layout(config):
+    logging.info("compile layout")
+
+    panel_margin = (
+        config["LAYOUT"]["MARGIN"]["WIDTH"],
+        config["LAYOUT"]["MARGIN"]["HEIGHT"],
+    )
+    panel_width = (
+        config["PANEL"]["DEVICE"]["WIDTH"] - config["LAYOUT"]["MARGIN"]["WIDTH"] * 2
+    )
+
+    item_list = []
+    icon_list = []
+    next_draw_y = 0
+    for panel_class in [SenseLargeHeaderPanel, SenseDetailPanel, UpdateTimePanel]:
+        panel = panel_class(
+            config, (panel_margin[0], panel_margin[1] + next_draw_y), panel_width
+        )
+        panel_item_list, panel_icon_list, next_draw_y = panel.layout()
+
+        item_list.extend(panel_item_list)
+        icon_list.extend(panel_icon_list)
+
+    return LayoutPlan(tuple(item_list), tuple(icon_list), next_draw_y)
+
+
+def get_layout_plan(config):
+    layout_key = get_layout_key(config)
+
+    if layout_key in layout_plan_cache:
+        return layout_plan_cache[layout_key]
+
+    cache_path = get_layout_cache_path(config, layout_key)
+    plan = None
+    if (cache_path is not None) and cache_path.exists():
+        logging.info("load layout from {path}".format(path=cache_path))
+        plan = load_layout_plan(cache_path)
+
+    if plan is None:
+        plan = compile_layout(config)
+        if cache_path is not None:
+            save_layout_plan(cache_path, plan)
+
+    layout_plan_cache[layout_key] = plan
+
+    return plan
+
+
+def get_item_region(config, key):
+    # NOTE: key に対応する値を描画する行全体の領域を返す
+    for item in get_layout_plan(config).item_list:
+        if item.key != key:
+            continue
+
+        bbox = measure_text(get_font(config, item.face), item.sample).bbox
+        return (
+            0,
+            max(int(item.pos[1] + bbox[1]) - 1, 0),
+            config["PANEL"]["DEVICE"]["WIDTH"],
+            int(item.pos[1] + bbox[3]) + 2,
+        )
+
+    return None
+
+
+def get_item_text(item, value_map):
+    if item.key is None:
+        return item.text
+    elif value_map.get(item.key) is None:
+        return "?  "
+    else:
+        return item.format.format(value_map[item.key])
+
+
+def get_value_map(sense_data, power_data, date):
+    value_map = {"time": date}
+
+    for label, value in power_data.items():
+        value_map["power.{label}".format(label=label)] = value
+
+    for i, data in enumerate(sense_data):
+        for param in ["temp", "humi", "co2"]:
+            if param in data:
+                value_map["room.{index}.{param}".format(index=i, param=param)] = data[
+                    param
+                ]
+
+    return value_map
+
+
+def is_static_item(item):
+    return (item.key is None) and (item.depend is None)
+
+
+def draw_item_list(config, img, item_list, value_map):
+    for item in item_list:
+        if (item.depend is not None) and (item.depend not in value_map):
+            continue
+
+        draw_text(
+            config,
+            img,
+            get_item_text(item, value_map),
+            item.pos,
+            item.face,
+            item.align == "left",
+            item.color,
+        )
+
+
+def get_static_layer(config, plan, mode, size):
+    # NOTE: アイコンやラベル，単位といった値によらない要素は一度だけ描画して使い回す
+    cache_key = (get_layout_key(config), mode, size)
+
+    if cache_key not in static_layer_cache:
+        logging.info("draw static layer")
+
+        img = PIL.Image.new(mode, size, "white")
+        for icon in plan.icon_list:
+            img.paste(get_icon(config, icon.name, mode), icon.pos)
+
+        draw_item_list(config, img, filter(is_static_item, plan.item_list), {})
+
+        static_layer_cache[cache_key] = img
+
+    return static_layer_cache[cache_key]
+
+
+def draw_layout_plan(config, img, plan, value_map):
+    img.paste(get_static_layer(config, plan, img.mode, img.size), (0, 0))
+
+    draw_item_list(
+        config,
+        img,
+        filter(lambda item: not is_static_item(item), plan.item_list),
+        value_map,
+    )
 
 
 ######################################################################
 def get_sensor_data_map(config):
     logging.info("fetch sensor data")
 
-    data = []
+    target_list = []
     for room in config["SENSOR"]["ROOM_LIST"]:
-        value = {"place": room["LABEL"]}
         for param in ["temp", "humi", "co2"]:
             if (room["HOST"]["TYPE"] == "esp32") and (param == "co2"):
                 continue
 
-            sensor_data = fetch_data(
-                get_db_config(config),
-                room["HOST"]["TYPE"],
-                room["HOST"]["NAME"],
-                param,
-                "1h",
-                last=True,
+            target_list.append(
+                {
+                    "measure": room["HOST"]["TYPE"],
+                    "hostname": room["HOST"]["NAME"],
+                    "field": param,
+                }
             )
-            if sensor_data["valid"]:
-                value[param] = sensor_data["value"][0]
+
+    data_map = fetch_last_data_batch(get_db_config(config), target_list)
+
+    data = []
+    for room in config["SENSOR"]["ROOM_LIST"]:
+        value = {"place": room["LABEL"]}
+        for param in ["temp", "humi", "co2"]:
+            key = (room["HOST"]["TYPE"], room["HOST"]["NAME"], param)
+            if key in data_map:
+                value[param] = data_map[key]
 
         data.append(value)
 
@@ -612,27 +771,19 @@ def get_sensor_data_map(config):
     return data
 
 
-def get_power_data(config, window_min):
-    return fetch_data(
+def get_power_data_map(config):
+    logging.info("fetch power data")
+
+    mean_map = fetch_window_mean(
         get_db_config(config),
         config["POWER"]["DATA"]["HOST"]["TYPE"],
         config["POWER"]["DATA"]["HOST"]["NAME"],
         "power",
-        "6h",
-        window_min,
-        window_min,
-        last=True,
-    )["value"][0]
-
-
-def get_power_data_map(config):
-    logging.info("fetch power data")
+        [3, 10, 60, 180],
+    )
 
     power_data = {
-        "3min": get_power_data(config, 3),
-        "10min": get_power_data(config, 10),
-        "60min": get_power_data(config, 60),
-        "180min": get_power_data(config, 180),
+        "{window}min".format(window=window): value for window, value in mean_map.items()
     }
     if power_data["3min"] is None:
         power_data["3min"] = power_data["10min"]
@@ -642,42 +793,29 @@ def get_power_data_map(config):
     return power_data
 
 
-def draw_sensor_panel(config, img):
-    sense_data = get_sensor_data_map(config)
-
-    next_draw_y = 0
-    panel_margin = [
-        config["LAYOUT"]["MARGIN"]["WIDTH"],
-        config["LAYOUT"]["MARGIN"]["HEIGHT"],
-    ]
+def get_panel_data(config, date=None):
+    # NOTE: date を指定すると，描画を前倒ししてもその時刻を表示する
+    return {
+        "sensor": get_sensor_data_map(config),
+        "power": get_power_data_map(config),
+        "date": date,
+    }
 
-    sense_header_panel = SenseLargeHeaderPanel(
-        config,
-        img,
-        np.array(panel_margin) + np.array([0, next_draw_y]),
-        config["PANEL"]["DEVICE"]["WIDTH"] - config["LAYOUT"]["MARGIN"]["WIDTH"] * 2,
-    )
 
-    next_draw_y = sense_header_panel.draw(
-        {
-            "power": get_power_data_map(config),
-        }
-    )
+def draw_sensor_panel(config, img, panel_data=None, date=None):
+    if panel_data is None:
+        panel_data = get_panel_data(config, date)
 
-    sense_detail_panel = SenseDetailPanel(
-        config,
-        img,
-        np.array(panel_margin) + np.array([0, next_draw_y]),
-        config["PANEL"]["DEVICE"]["WIDTH"] - config["LAYOUT"]["MARGIN"]["WIDTH"] * 2,
-    )
-    next_draw_y = sense_detail_panel.draw(sense_data)
+    now = panel_data.get("date")
+    if now is None:
+        now = datetime.datetime.now(
+            datetime.timezone(datetime.timedelta(hours=9), "JST")
+        )
 
-    update_time_panel = UpdateTimePanel(
+    logging.info("draw panel")
+    draw_layout_plan(
         config,
         img,
-        np.array(panel_margin) + np.array([0, next_draw_y]),
-        config["PANEL"]["DEVICE"]["WIDTH"] - config["LAYOUT"]["MARGIN"]["WIDTH"] * 2,
+        get_layout_plan(config),
+        get_value_map(panel_data["sensor"], panel_data["power"], now),
     )
-
-    now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9), "JST"))
-    next_draw_y = update_time_panel.draw({"date": now})
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import sqlite3
+import pathlib
+import hashlib
+import threading
+import time
+import logging
+
+import numpy as np
+
+# NOTE: しばらく更新されていない系列は，設定が変わって使われなくなったものとして消す
+RETENTION_DAY = 7
+
+# NOTE: 空きページの割合がこれを超えたら VACUUM で詰める
+VACUUM_FREE_RATIO = 0.3
+COMPACT_INTERVAL_SEC = 60 * 60
+
+store_map = {}
+store_map_lock = threading.Lock()
+
+
+def get_series_key(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def to_epoch(time):
+    return time.astype("datetime64[s]").astype(np.int64)
+
+
+# NOTE: sensor_data で取得した時系列を SQLite に保存しておき，プロセスを再起動
+# した後も差分の取得だけで済むようにする
+class SeriesStore:
+    def __init__(self, path):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.compact_time = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS series "
+            + "(key TEXT, time REAL, value REAL, PRIMARY KEY (key, time)) "
+            + "WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS series_meta (key TEXT PRIMARY KEY, updated REAL)"
+        )
+        self.conn.commit()
+
+    def load(self, key, since):
+        # NOTE: 時刻 (datetime64, UTC) と値 (float64) の配列を返す．NULL は NaN になる
+        with self.lock:
+            row_list = self.conn.execute(
+                "SELECT time, value FROM series WHERE key = ? AND time >= ? ORDER BY time",
+                (get_series_key(key), int(to_epoch(since))),
+            ).fetchall()
+
+        if len(row_list) == 0:
+            return (np.empty(0, dtype="datetime64[s]"), np.empty(0, dtype=np.float64))
+
+        time, value = zip(*row_list)
+
+        return (
+            np.array(time, dtype=np.int64).astype("datetime64[s]"),
+            np.array(value, dtype=np.float64),
+        )
+
+    def save(self, key, time_array, value_array, replace_from, cutoff):
+        series_key = get_series_key(key)
+
+        with self.lock:
+            with self.conn:
+                if replace_from is None:
+                    self.conn.execute("DELETE FROM series WHERE key = ?", (series_key,))
+                else:
+                    self.conn.execute(
+                        "DELETE FROM series WHERE key = ? AND time >= ?",
+                        (series_key, int(to_epoch(replace_from))),
+                    )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO series VALUES (?, ?, ?)",
+                    zip(
+                        [series_key] * len(time_array),
+                        to_epoch(time_array).tolist(),
+                        # NOTE: NaN は SQLite 上で NULL になる
+                        value_array.tolist(),
+                    ),
+                )
+                self.conn.execute(
+                    "DELETE FROM series WHERE key = ? AND time < ?",
+                    (series_key, int(to_epoch(cutoff))),
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO series_meta VALUES (?, ?)",
+                    (series_key, time.time()),
+                )
+
+            if (time.time() - self.compact_time) > COMPACT_INTERVAL_SEC:
+                self.compact()
+
+    def compact(self):
+        self.compact_time = time.time()
+
+        expire = time.time() - RETENTION_DAY * 24 * 60 * 60
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM series WHERE key IN "
+                + "(SELECT key FROM series_meta WHERE updated < ?)",
+                (expire,),
+            )
+            self.conn.execute("DELETE FROM series_meta WHERE updated < ?", (expire,))
+
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if (page_count != 0) and ((free_count / page_count) > VACUUM_FREE_RATIO):
+            logging.info(
+                "Vacuum series store (free: {free}/{total} pages)".format(
+                    free=free_count, total=page_count
+                )
+            )
+            self.conn.execute("VACUUM")
+
+
+def get_store(path):
+    with store_map_lock:
+        if path not in store_map:
+            logging.info("Open series store: {path}".format(path=path))
+            store_map[path] = SeriesStore(path)
+
+        return store_map[path]
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import paramiko
+import random
+import time
+import logging
+
+from frame_receiver import FrameReceiver, load_receiver_script
+
+KEEPALIVE_SEC = 15
+COMMAND_TIMEOUT_SEC = 30
+RECONNECT_COUNT = 3
+RECONNECT_BACKOFF_SEC = 2
+RECONNECT_JITTER = 0.5
+
+# NOTE: シェルの出力からコマンドの終了を判定するための目印
+END_MARKER = "__KINDLE_SENSOR_END__"
+
+RECEIVER_PATH = "kindle_receiver.sh"
+
+
+# NOTE: Kindle との SSH 接続を保持し，認証済みのトランスポートとシェルを使い回す．
+# 画像の転送は SFTP (使えない場合は同じトランスポート上の exec チャンネル) で行い，
+# eips などのコマンドは常駐させたシェルで実行する
+class KindleTransport:
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.ssh = None
+        self.sftp = None
+        self.shell = None
+        self.shell_stdout = None
+        self.receiver = None
+        self.is_sftp_available = True
+
+    def connect(self):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            self.hostname,
+            username="root",
+            password="mario",
+            allow_agent=False,
+            look_for_keys=False,
+        )
+        ssh.get_transport().set_keepalive(KEEPALIVE_SEC)
+
+        self.ssh = ssh
+
+        shell_stdin, shell_stdout, _ = ssh.exec_command("sh")
+        shell_stdout.channel.settimeout(COMMAND_TIMEOUT_SEC)
+        self.shell = shell_stdin
+        self.shell_stdout = shell_stdout
+
+        self.sftp = None
+        if self.is_sftp_available:
+            try:
+                self.sftp = ssh.open_sftp()
+            except Exception:
+                logging.warning(
+                    "SFTP is not available on {hostname}, use exec channel".format(
+                        hostname=self.hostname
+                    )
+                )
+                self.is_sftp_available = False
+
+        logging.info("Connected to {hostname}".format(hostname=self.hostname))
+
+    def close(self):
+        if self.ssh is not None:
+            try:
+                self.ssh.close()
+            except Exception:
+                pass
+
+        self.ssh = None
+        self.sftp = None
+        self.shell = None
+        self.shell_stdout = None
+        self.receiver = None
+
+    def is_alive(self):
+        # NOTE: ローカルの状態を見るだけなので，通信は発生しない
+        if self.ssh is None:
+            return False
+
+        transport = self.ssh.get_transport()
+
+        return (
+            (transport is not None)
+            and transport.is_active()
+            and not self.shell.channel.closed
+            and not self.shell.channel.exit_status_ready()
+        )
+
+    def ensure(self):
+        if self.is_alive():
+            return
+
+        self.close()
+
+        for i in range(RECONNECT_COUNT):
+            try:
+                self.connect()
+                return
+            except Exception:
+                self.close()
+                if i == (RECONNECT_COUNT - 1):
+                    raise
+
+                # NOTE: 複数の Kindle が同時に再接続しないように，待ち時間をばらつかせる
+                wait_sec = (RECONNECT_BACKOFF_SEC * (2**i)) * (
+                    1 + random.uniform(-RECONNECT_JITTER, RECONNECT_JITTER)
+                )
+                logging.warning(
+                    "Failed to connect to {hostname}, retry after {wait:.1f} sec".format(
+                        hostname=self.hostname, wait=wait_sec
+                    )
+                )
+                time.sleep(wait_sec)
+
+    def upload(self, path, data):
+        self.ensure()
+
+        if self.sftp is not None:
+            with self.sftp.open(path, "wb") as f:
+                # NOTE: 書き込みごとに応答を待たないようにする
+                f.set_pipelined(True)
+                f.write(data)
+        else:
+            ssh_stdin, ssh_stdout, _ = self.ssh.exec_command(
+                "cat - > {path}".format(path=path)
+            )
+            ssh_stdin.write(data)
+            ssh_stdin.close()
+
+            status = ssh_stdout.channel.recv_exit_status()
+            if status != 0:
+                raise RuntimeError(
+                    "Failed to upload {path} to {hostname} (status: {status})".format(
+                        path=path, hostname=self.hostname, status=status
+                    )
+                )
+
+    def run(self, command, check=True):
+        self.ensure()
+
+        try:
+            # NOTE: 標準エラー出力も読まないとウィンドウが埋まって止まるので，まとめる
+            self.shell.write(
+                "{{ {command}; }} 2>&1; echo {marker} $?\n".format(
+                    command=command, marker=END_MARKER
+                )
+            )
+            self.shell.flush()
+
+            while True:
+                line = self.shell_stdout.readline()
+                if line == "":
+                    raise RuntimeError(
+                        "Shell on {hostname} is closed".format(hostname=self.hostname)
+                    )
+                if END_MARKER in line:
+                    break
+        except Exception:
+            # NOTE: 応答の途中で失敗すると，シェルの入出力の対応が取れなくなる
+            self.close()
+            raise
+
+        status = int(line.split(END_MARKER)[1])
+        if check and (status != 0):
+            raise RuntimeError(
+                "Failed to execute '{command}' on {hostname} (status: {status})".format(
+                    command=command, hostname=self.hostname, status=status
+                )
+            )
+
+        return status
+
+    def get_receiver(self):
+        self.ensure()
+
+        if (self.receiver is not None) and (
+            self.receiver.stdin.channel.closed
+            or self.receiver.stdin.channel.exit_status_ready()
+        ):
+            self.receiver = None
+
+        if self.receiver is None:
+            # NOTE: 受信スクリプトは接続ごとに転送し直すので，更新すると次の接続から反映される
+            self.upload(RECEIVER_PATH, load_receiver_script())
+
+            receiver_stdin, receiver_stdout, _ = self.ssh.exec_command(
+                "sh {path}".format(path=RECEIVER_PATH)
+            )
+            receiver_stdout.channel.settimeout(COMMAND_TIMEOUT_SEC)
+
+            self.receiver = FrameReceiver(receiver_stdin, receiver_stdout)
+
+            logging.info(
+                "Started frame receiver on {hostname}".format(hostname=self.hostname)
+            )
+
+        return self.receiver
+
+    def stop_receiver(self):
+        if self.receiver is None:
+            return
+
+        try:
+            self.receiver.stdin.channel.close()
+        except Exception:
+            pass
+
+        self.receiver = None